@@ -6,14 +6,38 @@ from pathlib import Path
 from data import ROOT_DIR, resource_name
 from data.settings import PROFILE
 from nutil.vars import is_floatable
-from nutil.kex import widgets
 
 ASSETS_DIR = ROOT_DIR / 'assets'
 GRAPHICS_DIR = ASSETS_DIR / 'graphics'
 AUDIO_DIR = ASSETS_DIR / 'audio'
 
 
+class SoundHandle:
+    """
+    A sound file that is only loaded (along with the audio backend)
+    the first time it is played.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__sound = None
+
+    @property
+    def sound(self):
+        if self.__sound is None:
+            from nutil.kex import widgets
+            self.__sound = widgets.Sound.load(self.path)
+        return self.__sound
+
+    def play(self, *args, **kwargs):
+        self.sound.play(*args, **kwargs)
+
+    def __repr__(self):
+        return f'<SoundHandle {self.path}>'
+
+
 class Assets:
+    # Disable to skip playing (and loading) sounds, e.g. when running headless
+    audio_enabled = True
     missing_sfx = set()
     missing_images = set()
     FALLBACK_SPRITE = str(ASSETS_DIR / 'fallback.png')
@@ -51,11 +75,13 @@ class Assets:
             logger.info(f'Failed to find sfx: {sound_name} ({sound_path})')
             cls.missing_sfx.add(sound_name)
             return None
-        cls.SFX_CACHE[sound_name] = widgets.Sound.load(str(sound_path))
+        cls.SFX_CACHE[sound_name] = SoundHandle(str(sound_path))
         return cls.SFX_CACHE[sound_name]
 
     @classmethod
     def play_sfx(cls, sound_name, volume, **kwargs):
+        if not cls.audio_enabled:
+            return
         sfx = cls.get_sfx(sound_name)
         if sfx is None:
             return
@@ -293,6 +293,31 @@ default: 3000.0
 type: float
 caption: in ticks
 
+--- collision_broadphase_min
+default: 300.0
+type: float
+caption: unit count to use collision broadphase
+
+--- agency_budget
+default: 20.0
+type: float
+caption: max units acting per tick
+
+--- spatial_index_min
+default: 4000.0
+type: float
+caption: unit count to use spatial index
+
+--- phase_plan_stats
+default: 0
+type: bool
+caption: time ability phases (debug panel)
+
+--- record_replays
+default: 0
+type: bool
+caption: save a replay file of every encounter
+
 
 
 """
@@ -3,7 +3,6 @@ logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
 
 from data import CorruptedDataError
-from nutil.kex import widgets
 from nutil.debug import format_exc
 from nutil.vars import modify_color
 from nutil.file import file_dump, file_load
@@ -169,8 +168,7 @@ class Profile:
 
 
 GLOBAL_CANCEL_KEY = 'escape'
-_SETTINGS_IM = widgets.InputManager()
-_SETTINGS_IM.deactivate()
+_SETTINGS_IM = None
 
 WIDGET_SIZE = 400, 60
 MODIFIED_COLOR = 0.5, 0.3, 0, 0.5
@@ -216,6 +214,9 @@ class Setting:
         self.__value = self.from_str(self.__value_str)
         if self.__value_str != self.to_str(self.__value):
             raise ValueError(f'{self} to_str and from_str non-commutative {self.__value_str} != {self.to_str(self.__value)}')
+        # Widgets are only created when requested by the GUI
+        if self.__widget is None:
+            return
         self.set_widget_label()
         if trigger:
             logger.debug(f'Triggered on_set: {self}')
@@ -258,6 +259,7 @@ class Setting:
         if self.__widget is None:
             self.__widget, self._widget_label, self.cls_anchor = self.__make_widget()
             self.set_widget_label()
+            self.on_set()
         return self.__widget
 
     @property
@@ -267,11 +269,13 @@ class Setting:
         return self.__cls_widget
 
     def make_cls_widget(self):
+        from nutil.kex import widgets
         w = widgets.Label(text=self.display_value(self.value), markup=True)
         w.make_bg((0,0,0))
         return w
 
     def __make_widget(self):
+        from nutil.kex import widgets
         widget = widgets.BoxLayout()
         widget.set_size(*WIDGET_SIZE)
         widget.bind(on_touch_down=self.on_touch_down)
@@ -310,6 +314,7 @@ class StringSetting(Setting):
         return str(value)
 
     def make_cls_widget(self):
+        from nutil.kex import widgets
         return widgets.Entry(
             on_text=self.__on_text,
             background_color=(0,0,0,1),
@@ -355,6 +360,7 @@ class ColorSetting(Setting):
         return ', '.join(f'{_:.2f}' for _ in value)
 
     def make_cls_widget(self):
+        from nutil.kex import widgets
         w = widgets.ColorSelect(callback=self._on_color)
         w.set_color(self.value)
         w.set_size(y=50)
@@ -373,11 +379,6 @@ class ColorSetting(Setting):
 
 class SliderSetting(Setting):
     stype = 'slider'
-    def parse_raw_data(self, raw_data):
-        self._slider = widgets.Slider(on_value=self._on_value)
-        self._label = widgets.Label()
-        self._label.set_size(x=35)
-
     def from_str(self, s):
         r = round(float(s), 3)
         assert 0 <= r <= 1
@@ -389,6 +390,10 @@ class SliderSetting(Setting):
         return str(value)
 
     def make_cls_widget(self):
+        from nutil.kex import widgets
+        self._slider = widgets.Slider(on_value=self._on_value)
+        self._label = widgets.Label()
+        self._label.set_size(x=35)
         w = widgets.BoxLayout()
         w.add(self._slider)
         w.add(self._label)
@@ -423,6 +428,7 @@ class ChoiceSetting(Setting):
         self.widget_set_value(label)
 
     def make_cls_widget(self):
+        from nutil.kex import widgets
         w = widgets.DropDownSelect(callback=self._click_choice)
         w.set_options(self.options)
         w.set_size(y=45)
@@ -468,6 +474,7 @@ class BooleanSetting(Setting):
         return str(value)
 
     def make_cls_widget(self):
+        from nutil.kex import widgets
         w = widgets.CheckBox(active=self.value)
         w.bind(on_touch_down=self._on_touch_down)
         return w
@@ -494,6 +501,7 @@ class HotkeySetting(Setting):
         self.cls_widget.text = self.display_value(self.value)
 
     def make_cls_widget(self):
+        from nutil.kex import widgets
         w = widgets.ToggleButton()
         w.bind(state=self._on_state)
         w.background_color = 0.5, 0.4, 0.6, 1
@@ -501,11 +509,12 @@ class HotkeySetting(Setting):
         return w
 
     def _on_state(self, *a):
+        settings_im = _get_settings_im()
         if self.cls_widget.active:
-            _SETTINGS_IM.activate()
-            _SETTINGS_IM.record(on_release=self._end_record, on_press=self._new_record)
+            settings_im.activate()
+            settings_im.record(on_release=self._end_record, on_press=self._new_record)
         else:
-            _SETTINGS_IM.stop_record()
+            settings_im.stop_record()
             self.on_set()
 
     def _new_record(self, keys):
@@ -515,15 +524,25 @@ class HotkeySetting(Setting):
 
     def _end_record(self, keys):
         self.cls_widget.active = False
-        _SETTINGS_IM.deactivate()
+        _get_settings_im().deactivate()
         if keys == GLOBAL_CANCEL_KEY:
             keys = ''
         self.set_value(keys)
 
     def display_value(self, keys):
+        from nutil.kex import widgets
         return widgets.InputManager.humanize_keys(keys)
 
 
+def _get_settings_im():
+    global _SETTINGS_IM
+    if _SETTINGS_IM is None:
+        from nutil.kex import widgets
+        _SETTINGS_IM = widgets.InputManager()
+        _SETTINGS_IM.deactivate()
+    return _SETTINGS_IM
+
+
 _SETTING_TYPES_LIST = (
     StringSetting,
     ChoiceSetting,
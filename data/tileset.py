@@ -5,7 +5,6 @@ logger = logging.getLogger(__name__)
 
 import numpy as np
 import collections, tempfile
-from PIL import Image
 from pathlib import Path
 from nutil.random import Seed, SEED
 
@@ -36,15 +35,24 @@ class __TileMap:
     def __init__(self, tileset):
         self.last_file = 0
         self.tile_size = None
-        self.tiles = collections.defaultdict(lambda: list())
+        self.tileset = tileset
+        self.__tiles = None
         ts_size = TILESET_METADATA[tileset]['tile_size']
         if self.tile_size is None:
             self.tile_size = ts_size
         if self.tile_size != ts_size:
             raise RuntimeError(f'Cannot import multiple tilesets with different tile sizes ({self.tile_size} != {ts_size})')
-        self.load_tiles(tileset)
+
+    @property
+    def tiles(self):
+        # The tileset image is only loaded when first drawing a map
+        if self.__tiles is None:
+            self.__tiles = collections.defaultdict(lambda: list())
+            self.load_tiles(self.tileset)
+        return self.__tiles
 
     def load_tiles(self, tileset):
+        from PIL import Image
         tileset_name = f'{tileset}.png'
         tileset_file = str(TILESET_DIR/tileset_name)
         im = Image.open(tileset_file)
@@ -59,9 +67,10 @@ class __TileMap:
                 box = (x, y, x+size, y+size)
                 tile = im.crop(box)
                 category = next(categories)
-                self.tiles[category].append(tile)
+                self.__tiles[category].append(tile)
 
     def draw_map(self, size, default, tilemap):
+        from PIL import Image
         s = Seed('dev')
         tiles_x, tiles_y = size
         total_size = np.array(size) * self.tile_size
@@ -17,4 +17,4 @@ ProgressBar = _namedtuple('ProgressBar', ['value', 'text', 'color'])
 
 ControlEvent = _namedtuple('ControlEvent', ['name', 'index', 'description'])
 InputEvent = _namedtuple('InputEvent', ['name', 'pos', 'description'])
-CastEvent = _namedtuple('InputEvent', ['name', 'index', 'pos', 'alt', 'description'])
+CastEvent = _namedtuple('CastEvent', ['name', 'index', 'pos', 'alt', 'description'])
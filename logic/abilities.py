@@ -4,6 +4,7 @@ logger.setLevel(logging.DEBUG)
 
 
 import enum
+import time
 import collections
 import math
 import numpy as np
@@ -26,11 +27,15 @@ class BaseAbility:
     debug = False
     color = 0.5, 0.5, 0.5
     draft_cost = 100
+    # Per unit state fields and their defaults
+    STATE = {'loadcount': 0, 'selected': None}
 
     def __init__(self, aid, name, raw_data):
         self._raw_data = raw_data
         self.aid = aid
         self.name = name
+        self.passive_timer = f'{aid}-passive'
+        self.active_timer = f'{aid}-active'
         self.debug = 'debug' in raw_data.default.positional
         self.info = raw_data.default['info'] if 'info' in raw_data.default else self.info
         self.info = '\n'.join(raw_data['info'].positional) if 'info' in raw_data else self.info
@@ -53,7 +58,6 @@ class BaseAbility:
             self.phases[p] = Phase(self, p, phase_data)
         self.state_phase = self.phases[self.s2phase(raw_data['state']) if 'state' in raw_data.default else PHASE.ACTIVE]
         self.off_cooldown_phase = self.s2phase(raw_data.default['off_cooldown']) if 'off_cooldown' in raw_data.default else None
-        self.cached_selected_key = f'{self}-selected'
 
         # Parse effects
         for effect_full_name, effect_data in raw_data.items():
@@ -75,6 +79,10 @@ class BaseAbility:
         self.fail_sfx = 'no_fail_sfx' not in self._raw_data.default.positional
         self.upcast_sfx = 'no_upcast_sfx' not in self._raw_data.default.positional
 
+    def _compile(self):
+        for phase in self.phases.values():
+            phase.compile()
+
     # STAT BONUS AND BALANCE
     @staticmethod
     def _parse_stats(raw_data):
@@ -91,70 +99,34 @@ class BaseAbility:
             stats.append((stat, statval, formula))
         return stats
 
-    def balance_stats(self, api, uid):
-        if not self.stats:
-            return
-        with api.single_timers[f'passive-stat-balance'].time_block:
-            unit = api.units[uid]
-            for i, balance_entry in enumerate(unit.cache[f'{self}-stats']):
-                stat, value, formula, pre_bonus = balance_entry
-                target_value = formula.get_value(api, uid)
-                if value is VALUE.DELTA:
-                    target_value = ticks2s(target_value)
-                delta = target_value - pre_bonus
-                if delta == 0:
-                    continue
-                pre_stat = api.get_stats(uid, stat, value)
-                api.set_stats(uid, stat, delta, value, additive=True)
-                post_stat = api.get_stats(uid, stat, value)
-                actual_delta = post_stat - pre_stat
-                unit.cache[f'{self}-stats'][i][3] += actual_delta
-
-    def remove_stats(self, api, uid):
-        if not self.stats:
-            return
-        unit = api.units[uid]
-        for i, (stat, value, formula, bonus) in enumerate(unit.cache[f'{self}-stats']):
-            pre_stat = api.get_stats(uid, stat, value)
-            api.set_stats(uid, stat, -bonus, value_name=value, additive=True)
-            post_stat = api.get_stats(uid, stat, value)
-            actual_delta = pre_stat - post_stat
-            unit.cache[f'{self}-stats'][i][3] -= actual_delta
-            logger.info(f'Removed stat {stat} {value} {formula} {bonus} from {unit.name}: {actual_delta}')
-            if actual_delta != bonus:
-                logger.warning(f'Removed ability stat bonus but result is nonzero. Bonus to remove {bonus}, actual delta: {actual_delta}')
-
     def load_on_unit(self, api, uid):
-        unit = api.units[uid]
-        if unit.cache[f'{self}-loadcount'] is not None:
-            unit.cache[f'{self}-loadcount'] += 1
-            return
-        unit.cache[f'{self}-loadcount'] = 1
-        unit.cache[f'{self}-stats'] = [[s, v, f, 0] for s,v,f in self.stats]
+        loadcount = api.units[uid].ability_state.loadcount
+        loadcount[self.aid] += 1
+        if loadcount[self.aid] == 1 and self.stats:
+            api.logic.passives.load(uid, self.bonus_entries)
 
     def unload_from_unit(self, api, uid):
-        unit = api.units[uid]
-        loadcount = unit.cache[f'{self}-loadcount']
-        if loadcount == 0:
+        loadcount = api.units[uid].ability_state.loadcount
+        if loadcount[self.aid] == 0:
             logger.warning(f'{self} requested to unload but found loadcount 0')
-        if loadcount <= 1:
-            unit.cache[f'{self}-loadcount'] = 0
-            self.remove_stats(api, uid)
+        if loadcount[self.aid] <= 1:
+            loadcount[self.aid] = 0
+            if self.stats:
+                api.logic.passives.unload(api, uid, self.bonus_entries)
         else:
-            unit.cache[f'{self}-loadcount'] -= 1
+            loadcount[self.aid] -= 1
 
     # PHASES
     def passive(self, api, uid, dt):
-        with api.ability_timers[f'{self.aid}-passive'].time_block:
-            self.balance_stats(api, uid)
+        with api.ability_timers[self.passive_timer].time_block:
             phase = self.phases[PHASE.PASSIVE]
             phase.apply_effects(api, uid, dt)
         return self.aid
 
-    def active(self, api, uid, target_point, alt=0):
-        with api.ability_timers[f'{self.aid}-active'].time_block:
+    def active(self, api, uid, target_point, alt=0, nearest=None):
+        with api.ability_timers[self.active_timer].time_block:
             phase = self.phases[PHASE.ACTIVE if alt == 0 else PHASE.ALT]
-            phase.apply_effects(api, uid, dt=0, target_point=target_point)
+            phase.apply_effects(api, uid, dt=0, target_point=target_point, nearest=nearest)
         return self.aid
 
     def off_cooldown(self, api, uid):
@@ -242,7 +214,14 @@ class BaseAbility:
         return ''
 
     def cache_selected(self, api, uid):
-        return api.units[uid].cache[self.cached_selected_key]
+        return api.units[uid].ability_state.selected[self.aid]
+
+    @property
+    def moves_units(self):
+        return any(phase.moves_units for phase in self.phases.values())
+
+    def find_nearest(self, api, uids, alt=0):
+        return self.phases[PHASE.ACTIVE if alt == 0 else PHASE.ALT].find_nearest(api, uids)
 
     def __repr__(self):
         return f'{self.aid} {self.name}'
@@ -262,6 +241,68 @@ class BaseAbility:
 ABILITY_CLASSES = {
     'base': BaseAbility,
 }
+# Per unit state fields of all ability classes, see StateTable
+ABILITY_STATE = {name: default for cls in ABILITY_CLASSES.values() for name, default in cls.STATE.items()}
+
+
+class PassiveLedger:
+    """
+    Passive stat bonuses of the abilities loaded on every unit. Owned by the
+    encounter, such that the bonuses of many units can be balanced at once.
+
+    Every stat bonus of every ability is an entry (see BONUS_ENTRIES), and
+    entries that bonus the same stat value share a cell. The ledger keeps
+    which entries are loaded on each unit, and the bonus applied to each
+    cell of each unit. Balancing evaluates the formula of each entry for all
+    its units at once, and applies the difference between the target and
+    applied bonuses of all cells in a single operation.
+    """
+    def __init__(self):
+        self.loaded = np.zeros((0, len(BONUS_ENTRIES)), dtype=np.bool)
+        self.applied = np.zeros((0, len(BONUS_CELL_STATS)))
+
+    def _ensure_rows(self, count):
+        if count <= len(self.loaded):
+            return
+        rows = max(count, 2 * len(self.loaded))
+        self.loaded = np.concatenate([self.loaded, np.zeros((rows - len(self.loaded), self.loaded.shape[1]), dtype=np.bool)])
+        self.applied = np.concatenate([self.applied, np.zeros((rows - len(self.applied), self.applied.shape[1]))])
+
+    def load(self, uid, entries):
+        self._ensure_rows(uid + 1)
+        self.loaded[uid, entries] = True
+
+    def unload(self, api, uid, entries):
+        """Unload entries, removing their bonus immediately."""
+        self.loaded[uid, entries] = False
+        self.balance(api, np.array([uid]))
+
+    def balance(self, api, uids):
+        """Set the bonuses of uids (unique) to the current value of their loaded entries."""
+        self._ensure_rows(api.unit_count)
+        loaded = self.loaded[uids]
+        targets = np.zeros((len(uids), len(BONUS_CELL_STATS)))
+        for entry in np.flatnonzero(loaded.any(axis=0)):
+            formula, per_tick, cell = BONUS_ENTRIES[entry]
+            rows = np.flatnonzero(loaded[:, entry])
+            values = formula.get_values(api, uids[rows])
+            targets[rows, cell] += ticks2s(values) if per_tick else values
+        deltas = targets - self.applied[uids]
+        rows, cells = np.nonzero(deltas)
+        if len(rows) == 0:
+            return
+        cell_uids = uids[rows]
+        self.applied[cell_uids, cells] += api.stats.add_bonuses(
+            cell_uids, BONUS_CELL_STATS[cells], BONUS_CELL_VALUES[cells], deltas[rows, cells])
+
+    def debug_str(self, uid):
+        if uid >= len(self.loaded):
+            return 'No passive bonuses'
+        strs = []
+        for cell in np.flatnonzero(self.applied[uid]):
+            stat, value = STAT(BONUS_CELL_STATS[cell]), VALUE(BONUS_CELL_VALUES[cell])
+            strs.append(f'{stat.name.lower()}.{value.name.lower()}: {nsign_str(round(self.applied[uid, cell], 3))}')
+        return '\n'.join(strs) if strs else 'No passive bonuses'
 
 
 class Phase:
@@ -308,6 +349,7 @@ class Phase:
             CONDITION.UPCAST: [],
             CONDITION.DOWNCAST: [],
         }
+        self.plan = None
 
         if self.debug:
             logger.info(f'Logging {self.ability} {self.phase_name} debug')
@@ -315,15 +357,29 @@ class Phase:
     def __repr__(self):
         return f'<{self.ability.name} {self.ability.aid} {self.phase_name} phase>'
 
-    def apply_effects(self, api, uid, dt, target_point=None):
-        if not self.has_effect:
+    def compile(self):
+        self.plan = PhasePlan(self)
+
+    def empty_target(self, target):
+        """If the target mask of an effect is always empty when cast from this phase."""
+        if target == 'area':
+            return not self.area
+        if target == 'single':
+            return self.target == 'none'
+        return False
+
+    def apply_effects(self, api, uid, dt, target_point=None, nearest=None):
+        plan = self.plan
+        if not plan.has_effect:
             return
+        if PhasePlan.instrument:
+            t0 = time.perf_counter()
         with api.single_timers[self.phase_name].time_block:
             if target_point is None:
                 target_point = api.get_position(uid)
             target_point = Mechanics.bound_to_map(api.logic, target_point)
             # Collect targets
-            targets = self.get_targets(api, uid, target_point, dt)
+            targets = self.get_targets(api, uid, target_point, dt, nearest)
             if self.debug:
                 d = ' '.join(str(_) for _ in [
                     'fails:', targets.fails,
@@ -336,12 +392,9 @@ class Phase:
                 ])
                 target_str = f'{"*" if self.targeting_point else ""}point: {self.point} {"" if self.targeting_point else "*"}target: {self.target} '
                 logger.info(f'Tick: {api.tick} UID: {uid}, {self} found: {target_str} {d}')
-            # Unconditional effects
-            for effect in self.effects[CONDITION.UNCONDITIONAL]:
-                effect.apply(api, uid, targets)
-            # Conditional (upcast/downcast) effects
+            # Unconditional and conditional (upcast/downcast) effects
             condition = CONDITION.DOWNCAST if targets.fails else CONDITION.UPCAST
-            for effect in self.effects[condition]:
+            for effect in plan.effects[condition]:
                 effect.apply(api, uid, targets)
             # Auto SFX
             if targets.fails:
@@ -351,6 +404,9 @@ class Phase:
             else:
                 if self.auto_sfx:
                     self.ability.play_sfx()
+        if PhasePlan.instrument:
+            plan.calls += 1
+            plan.elapsed += time.perf_counter() - t0
 
     def add_effect(self, condition, effect):
         self.effects[condition].append(effect)
@@ -421,7 +477,7 @@ class Phase:
         if uid in api.logic.miss_feedback_uids:
             api.add_visual_effect(VFX.LINE, 15, params=params)
 
-    def get_targets(self, api, uid, target_point, dt=0):
+    def get_targets(self, api, uid, target_point, dt=0, nearest=None):
         fails = set()
         # Resolve target point
         source_point = api.get_position(uid)
@@ -444,7 +500,6 @@ class Phase:
                     self.draw_miss(api, uid, p1=source_point, p2=fixed_target_point)
 
         live_mask = api.get_stats(slice(None), STAT.HP) > 0
-        range_mask = api.unit_distance(uid) <= range
         empty_mask = Mechanics.mask(api, [])
 
         # Resolve selected
@@ -457,17 +512,20 @@ class Phase:
         # Resolve single and area targets
         single_target_uid = None
         area_uids = []
-        available_targets = self.get_allegiance_mask(api, uid) if self.target != 'selected' else selected
-        available_targets = available_targets & live_mask
-        if available_targets.sum() == 0:
+        # The nearest available target may be given as (uid, distance) by find_nearest
+        if nearest is not None and not self.area:
+            single_target_uid, single_target_dist = nearest
+            has_available = single_target_uid is not None
+        else:
+            available_targets = self.get_allegiance_mask(api, uid) if self.target != 'selected' else selected
+            available_targets = available_targets & live_mask
+            has_available = available_targets.sum() > 0
+            if has_available:
+                single_target_uid, single_target_dist = api.nearest(target_point, available_targets)
+        if not has_available:
             if not self.targeting_point:
                 fails.add(FAIL_RESULT.MISSING_TARGET)
         else:
-            subset_uids = np.flatnonzero(available_targets)
-            subset_distances = api.get_distances(target_point, subset_uids)
-            idx = NP.argmin(subset_distances)
-            single_target_uid = subset_uids[idx]
-            single_target_dist = subset_distances[idx]
             if single_target_dist > self.single_selection_distance.get_value(api, uid):
                 single_target_uid = None
                 if not self.targeting_point:
@@ -482,7 +540,7 @@ class Phase:
                     single_target_uid = None
                     fails.add(FAIL_RESULT.OUT_OF_RANGE)
 
-            if self.area:
+            if self.plan.needs_area:
                 # Find origin / direction
                 area_direction = target_point
                 if single_target_uid is not None and not self.targeting_point:
@@ -492,18 +550,14 @@ class Phase:
                     radius = self.area_radius.get_value(api, uid)
                     if self.include_hitbox:
                         radius += Mechanics.get_stats(api, uid, STAT.HITBOX)
-                    subset_in_radius = api.get_distances(area_direction, subset_uids) < radius
-                    area_uids = subset_uids[np.flatnonzero(subset_in_radius)]
+                    area_uids = api.within_radius(area_direction, radius, available_targets)
                 # Find rectangle
                 elif self.area_shape == 'rect':
                     offset = Mechanics.get_stats(api, uid, STAT.HITBOX) if self.include_hitbox else 0
                     width = self.area_width.get_value(api, uid)
                     length = self.area_length.get_value(api, uid)
-                    hb_radius = Mechanics.get_stats(api, subset_uids, STAT.HITBOX)
                     rect = Rect.from_point(source_point, area_direction, width, length, offset)
-                    subset_pos = api.get_position(np.vstack(subset_uids))
-                    subset_in_rect = rect.check_colliding_circles(subset_pos, hb_radius)
-                    area_uids = subset_uids[subset_in_rect]
+                    area_uids = api.intersecting_rect(rect, available_targets)
                     if self.debug:
                         EffectVFXRect.draw_rect(api, rect, 10)
 
@@ -515,6 +569,39 @@ class Phase:
             fails |= self.check_pay(api, uid)
         return Targets(self.ability.aid, dt, fails, source_point, target_point, single_target_mask, area_mask, selected)
 
+    batch_targets = {'other', 'ally', 'enemy', 'neutral'}
+    def find_nearest(self, api, uids):
+        """
+        Find the nearest available target for each of uids casting at their
+        own position, as get_targets would. Returns a list of (uid, distance)
+        with uid None if there is no available target, or None if this phase
+        cannot be resolved in a batch.
+        """
+        if self.area or self.target not in self.batch_targets:
+            return None
+        points = Mechanics.bound_to_map_batch(api.logic, api.get_positions(uids))
+        all_positions = api.get_positions()
+        distances = np.linalg.norm(all_positions[np.newaxis] - points[:, np.newaxis], axis=-1)
+        distances -= api.get_stats(slice(None), STAT.HITBOX)
+        distances[distances < 0] = 0
+        allegiances = api.get_stats(slice(None), STAT.ALLEGIANCE)
+        my_allegiances = allegiances[uids, np.newaxis]
+        if self.target == 'ally':
+            available = allegiances == my_allegiances
+        elif self.target == 'neutral':
+            available = np.repeat((allegiances < 0)[np.newaxis], len(uids), axis=0)
+        elif self.target == 'enemy':
+            available = (allegiances != my_allegiances) & (allegiances >= 0)
+        else:
+            available = np.ones(distances.shape, dtype=bool)
+        available[np.arange(len(uids)), uids] = self.include_self
+        available &= api.get_stats(slice(None), STAT.HP) > 0
+        distances[~available] = float('inf')
+        idx = distances.argmin(axis=1)
+        nearest_distances = distances[np.arange(len(uids)), idx]
+        has_available = available.any(axis=1)
+        return [(i, d) if has else (None, None) for i, d, has in zip(idx, nearest_distances, has_available)]
+
     def get_allegiance_mask(self, api, uid):
         if self.target == 'none':
             return Mechanics.mask(api)
@@ -565,6 +652,10 @@ class Phase:
     def has_effect(self):
         return any([len(self.effects[c]) > 0 for c in CONDITION])
 
+    @property
+    def moves_units(self):
+        return any(e.moves_units for effects in self.effects.values() for e in effects)
+
     sorted_fails = [
         FAIL_RESULT.CRITICAL_ERROR,
         FAIL_RESULT.OUT_OF_ORDER,
@@ -581,6 +672,51 @@ class Phase:
         return cls.sorted_fails.index(x)
 
 
+class PhasePlan:
+    """
+    Flat execution plan of a phase, compiled when abilities are loaded.
+
+    The unconditional effects are joined with the effects of each condition,
+    leaving out effects that cannot fire from the phase (see Effect.can_fire).
+    The area of the phase is only resolved if an effect targets it.
+    """
+    # Count executions and time of every plan, shown in the debug panel
+    instrument = False
+    plans = []
+
+    def __init__(self, phase):
+        self.name = f'{phase.ability.name} {phase.phase_name}'
+        self.has_effect = phase.has_effect
+        unconditional = phase.effects[CONDITION.UNCONDITIONAL]
+        self.effects = {}
+        for condition in (CONDITION.UPCAST, CONDITION.DOWNCAST):
+            effects = unconditional + phase.effects[condition]
+            self.effects[condition] = tuple(e for e in effects if e.can_fire(phase))
+        fired = self.effects[CONDITION.UPCAST] + self.effects[CONDITION.DOWNCAST]
+        targets_area = any(getattr(e, 'target', None) == 'area' for e in fired)
+        self.needs_area = phase.area and (targets_area or phase.debug)
+        self.skipped = sum(len(_) for _ in phase.effects.values()) - len(set(fired))
+        self.calls = 0
+        self.elapsed = 0
+        self.plans.append(self)
+
+    @classmethod
+    def reset_stats(cls):
+        for plan in cls.plans:
+            plan.calls = plan.elapsed = 0
+
+    @classmethod
+    def debug_str(cls, count=15):
+        plans = sorted((p for p in cls.plans if p.calls > 0), key=lambda p: -p.elapsed)
+        strs = [f'{len(plans)} plans executed ({sum(p.skipped for p in cls.plans)} effects skipped)']
+        for plan in plans[:count]:
+            strs.append(f'{plan.name}: {plan.calls} × {plan.elapsed / plan.calls * 1000:.3f} ms')
+        return '\n'.join(strs)
+
+    def __repr__(self):
+        return f'<{self.name} plan: {len(self.effects[CONDITION.UPCAST])} upcast, {len(self.effects[CONDITION.DOWNCAST])} downcast>'
+
+
 class SentinelValue:
     pass
 
@@ -613,6 +749,7 @@ def resolve_formula(name, raw_data, sentinel=SentinelValue):
 
 class Formula:
     name = 'base'
+    is_constant = True
     def __init__(self, raw_param):
         self.__raw_param = raw_param
 
@@ -639,6 +776,21 @@ class Formula:
     def get_value(self, api, uid):
         return self.__raw_param
 
+    def get_values(self, api, uids):
+        """Values for an array of uids."""
+        return np.full(len(uids), self.__raw_param)
+
+    def _memoized_value(self, api, uid):
+        # Stat based values are memoized by (formula, uid) until the next
+        # stat write or tick, see UnitStats.value_memo
+        if not isinstance(uid, (int, np.integer)):
+            return self.get_values(api, uid)
+        key = self, uid
+        value = api.value_memo.get(key)
+        if value is None:
+            value = api.value_memo[key] = self.get_values(api, uid)
+        return value
+
     def full_str(self, key, nl=True):
         if not self.name == 'base':
             nl = '\n' if nl else ''
@@ -651,6 +803,7 @@ class Formula:
 
 class BonusFormula(Formula):
     name = 'bonus'
+    is_constant = False
     def __init__(self, raw_param):
         super().__init__(raw_param)
         base, stat, factor = [_.strip() for _ in raw_param.split(',')]
@@ -667,11 +820,15 @@ class BonusFormula(Formula):
         return f'{self._base} + [b]{self._stat.name.lower()}[/b] ×{self._factor}'
 
     def get_value(self, api, uid):
-        return self._base + self._factor * Mechanics.get_stats(api, uid, self._stat)
+        return self._memoized_value(api, uid)
+
+    def get_values(self, api, uids):
+        return self._base + self._factor * Mechanics.get_stats(api, uids, self._stat)
 
 
 class ScaleFormula(Formula):
     name = 'scaling'
+    is_constant = False
     ascending_scale = True
 
     def __init__(self, raw_param):
@@ -679,7 +836,7 @@ class ScaleFormula(Formula):
         min_, stat, max_, curve = raw_param.split(', ')
         self._min = float(min_)
         if stat == 'time':
-            self.get_stat = lambda a, u: ticks2s(a.tick)/60
+            self.get_stat = lambda a, u: np.full(np.shape(u), ticks2s(a.tick)/60)
             self.stat_name = 'time'
         else:
             self.get_stat = lambda a, u, s=str2stat(stat): Mechanics.get_stats(a, u, s)
@@ -699,7 +856,10 @@ class ScaleFormula(Formula):
         return f'{self._max} > [b]{self.stat_name}[/b]§{self._curve} > {self._min}'
 
     def get_value(self, api, uid):
-        stat = self.get_stat(api, uid)
+        return self._memoized_value(api, uid)
+
+    def get_values(self, api, uids):
+        stat = self.get_stat(api, uids)
         scale = self._scale * Mechanics.scaling(stat, self._curve, ascending=self.ascending_scale)
         return self._min + scale
 
@@ -715,12 +875,23 @@ class ReducFormula(ScaleFormula):
 
 
 class Effect:
+    # Effects that set unit positions directly (rather than moving them over ticks)
+    moves_units = False
+    # Effects that do nothing if their target mask is empty
+    empty_target_noop = False
+
     def __init__(self, phase, raw_data):
         pass
 
     def repr(self, au):
         return ''
 
+    def can_fire(self, phase):
+        """False if the effect can be shown to do nothing when cast from phase."""
+        if self.empty_target_noop:
+            return not phase.empty_target(self.target)
+        return True
+
     valid_mask_targets = {'self', 'single', 'area', 'selected'}
     valid_point_targets = {'self', 'source', 'point', 'single', 'selected'}
     valid_uid_targets = {'self', 'single', 'selected'}
@@ -811,6 +982,7 @@ class EffectMove(Effect):
 
 class EffectPush(Effect):
     effect_name = 'Push'
+    empty_target_noop = True
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'single'
         self.point = raw_data['point'] if 'point' in raw_data else 'point'
@@ -842,6 +1014,12 @@ class EffectPush(Effect):
             extra_str = f' for {extra_str}'
         return f'[u][b]{self.effect_name}[/b]{extra_str}[/u]{self.distance.full_str("Distance: ")}{self.duration.full_str("Duration: ")}{self.speed.full_str("Speed: ")}'
 
+    def can_fire(self, phase):
+        if self.speed.is_constant and self.duration.is_constant:
+            if ticks2s(self.speed.base_value) + s2ticks(self.duration.base_value) <= 0:
+                return False
+        return super().can_fire(phase)
+
     def apply(self, api, uid, targets):
         # Resolve targets
         target_point = self.resolve_target_point(api, uid, self.point, targets)
@@ -911,6 +1089,8 @@ class EffectLoot(Effect):
 
 
 class EffectTeleport(Effect):
+    moves_units = True
+
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'point'
         self.offset = resolve_formula('offset', raw_data, 0)
@@ -932,6 +1112,8 @@ class EffectTeleport(Effect):
 
 
 class EffectTeleportHome(Effect):
+    moves_units = True
+
     def repr(self, au):
         return '[u][b]Teleport home[/b][/u]'
 
@@ -941,6 +1123,8 @@ class EffectTeleportHome(Effect):
 
 
 class EffectStatus(Effect):
+    empty_target_noop = True
+
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'single'
         assert self.target in self.valid_mask_targets
@@ -1029,6 +1213,8 @@ class EffectStatus(Effect):
 
 
 class EffectStat(Effect):
+    empty_target_noop = True
+
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'single'
         assert self.target in self.valid_mask_targets
@@ -1048,6 +1234,8 @@ class EffectStat(Effect):
 
 
 class EffectSteal(Effect):
+    empty_target_noop = True
+
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'single'
         assert self.target in self.valid_mask_targets
@@ -1077,6 +1265,7 @@ class EffectSteal(Effect):
 
 class EffectRegen(Effect):
     is_degen = False
+    empty_target_noop = True
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'single'
         assert self.target in self.valid_mask_targets
@@ -1119,6 +1308,8 @@ class EffectDegen(EffectRegen):
 
 
 class EffectHit(Effect):
+    empty_target_noop = True
+
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'single'
         assert self.target in self.valid_mask_targets
@@ -1135,6 +1326,8 @@ class EffectHit(Effect):
 
 
 class EffectBlast(Effect):
+    empty_target_noop = True
+
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'area'
         assert self.target in self.valid_mask_targets
@@ -1168,7 +1361,7 @@ class EffectSelect(Effect):
         if targets.fails & self.undismissable_fails:
             return
         target_mask = self.resolve_target_mask(api, uid, self.target, targets)
-        api.units[uid].cache[self.ability.cached_selected_key] = target_mask
+        api.units[uid].ability_state.selected[self.ability.aid] = target_mask
 
 
 class EffectUnselect(EffectSelect):
@@ -1176,7 +1369,7 @@ class EffectUnselect(EffectSelect):
         return 'Unselect a target'
 
     def apply(self, api, uid, targets):
-        api.units[uid].cache[self.ability.cached_selected_key] = None
+        api.units[uid].ability_state.selected[self.ability.aid] = None
         # if uid not in api.logic.miss_feedback_uids:
         #     return
         # Assets.play_sfx('ui.inactive', volume='feedback')
@@ -1226,6 +1419,8 @@ class EffectRecast(Effect):
 
 
 class EffectShopkeeper(Effect):
+    empty_target_noop = True
+
     def __init__(self, phase, raw_data):
         self.target = raw_data['target'] if 'target' in raw_data else 'area'
         assert self.target in self.valid_mask_targets
@@ -1485,7 +1680,29 @@ def _load_abilities():
         abilities.append(ability)
     for ability in abilities:
         ability._setup()
+        ability._compile()
     logger.info(f'Loaded {len(abilities)} abilities.')
     return abilities
 
+
+def _index_bonuses(abilities):
+    """
+    Index the passive stat bonuses of all abilities for the PassiveLedger.
+    Every bonus is an entry of (formula, is per tick, cell), and every
+    distinct (stat, value) bonused is a cell.
+    """
+    entries = []
+    cells = {}
+    for ability in abilities:
+        ability.bonus_entries = []
+        for stat, value, formula in ability.stats:
+            cell = cells.setdefault((stat, value), len(cells))
+            ability.bonus_entries.append(len(entries))
+            entries.append((formula, value is VALUE.DELTA, cell))
+    cell_stats = np.array([stat for stat, value in cells], dtype=np.int64)
+    cell_values = np.array([value for stat, value in cells], dtype=np.int64)
+    return entries, cell_stats, cell_values
+
+
 ABILITIES = _load_abilities()
+BONUS_ENTRIES, BONUS_CELL_STATS, BONUS_CELL_VALUES = _index_bonuses(ABILITIES)
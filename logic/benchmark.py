@@ -0,0 +1,240 @@
+"""
+Microbenchmarks for engine kernels.
+
+Usage: python -m logic.benchmark [name ...]
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+
+from logic.common import *
+from logic.engine import UnitStats, get_unit_stats_template
+
+
+BENCHMARKS = {}
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+def timeit(f, repeat=20):
+    """Return the best time of *repeat* calls of f, in ms."""
+    best = float('inf')
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def make_stats(count, density=0.0005, seed=0):
+    """
+    Create a UnitStats with *count* live units scattered uniformly over
+    a square map, such that there are *density* units per square unit.
+    """
+    rng = np.random.default_rng(seed)
+    stats = UnitStats()
+    map_size = (count / density) ** 0.5
+    template = get_unit_stats_template()
+    matrix = np.repeat(template[np.newaxis], count, axis=0)
+    pos = rng.random((count, 2)) * map_size
+    for value in (VALUE.CURRENT, VALUE.TARGET):
+        matrix[:, STAT.POS_X, value] = pos[:, 0]
+        matrix[:, STAT.POS_Y, value] = pos[:, 1]
+    matrix[:, STAT.HITBOX, VALUE.CURRENT] = rng.uniform(20, 60, count)
+    matrix[:, STAT.HP, VALUE.CURRENT] = 100
+    matrix[:, STAT.HP, VALUE.MAX] = 100
+    stats.add_units(matrix)
+    return stats, map_size
+
+
+def report(title, columns, rows):
+    print(title)
+    print(''.join(f'{c:>16}' for c in columns))
+    for row in rows:
+        print(''.join(f'{c:>16.3f}' if isinstance(c, float) else f'{c:>16}' for c in row))
+    print()
+
+
+@benchmark
+def collision():
+    rows = []
+    for count in (50, 100, 200, 400, 800, 1600, 3200):
+        stats, map_size = make_stats(count)
+        colliders = np.flatnonzero(stats._collision_flags)
+        dense = timeit(lambda: stats._collision_pairs_dense(colliders), repeat=5 if count > 1000 else 20)
+        grid = timeit(lambda: stats._collision_pairs_grid(colliders))
+        rows.append((count, dense, grid, dense / grid))
+    report('Collision broadphase (ms)', ('units', 'dense', 'grid', 'speedup'), rows)
+
+
+@benchmark
+def minmax_cap():
+    rows = []
+    for count in (100, 1000, 5000):
+        stats, map_size = make_stats(count)
+        uid = count // 2
+        full = timeit(stats._cap_minmax_values, repeat=200)
+        cells = timeit(lambda: stats._cap_minmax_cells(uid, STAT.HP), repeat=200)
+        rows.append((count, full, cells, full / cells))
+    report('Min/max cap after single cell set_stats (ms)', ('units', 'full', 'cells', 'speedup'), rows)
+
+
+@benchmark
+def spatial():
+    from logic.mechanics import Rect
+    rows = []
+    queries = 100
+    for count in (500, 1000, 1500, 2000, 3000, 4000, 8000):
+        stats, map_size = make_stats(count, density=count / 10_000**2)
+        rng = np.random.default_rng(1)
+        points = rng.random((queries, 2)) * map_size
+        rects = [Rect.from_point(p, p + 100, 200, 600) for p in points]
+        mask = rng.random(count) < 0.5
+        def run_queries():
+            # Positions change every tick, so both paths start cold
+            stats._invalidate_distances()
+            for point, rect in zip(points, rects):
+                stats.nearest(point, mask)
+                stats.within_radius(point, 500, mask)
+                stats.intersecting_rect(rect, mask)
+        stats.spatial_index_min = float('inf')
+        brute = timeit(run_queries, repeat=5)
+        stats.spatial_index_min = 0
+        def build():
+            stats._invalidate_distances()
+            stats._spatial_grid()
+        build_time = timeit(build)
+        grid = timeit(run_queries, repeat=5)
+        rows.append((count, brute / queries, build_time, grid / queries, brute / grid))
+    report('Spatial queries on a 10k map, per nearest+radius+rect including rebuilds (ms)', ('units', 'brute', 'grid build', 'grid', 'speedup'), rows)
+
+
+def make_creep_wave(count, seed=0):
+    """
+    Create a headless encounter with *count* extra live creeps spread
+    around the player spawn. Returns the encounter and the creep uids.
+    """
+    from logic.headless import make_encounter
+    api = make_encounter(seed=seed)
+    api.toggle_play(set_to=True)
+    rng = np.random.default_rng(seed)
+    spawn = api.map.player_spawn
+    spawns = [('small creep' if i % 2 else 'huge creep', spawn + rng.uniform(-2000, 2000, 2)) for i in range(count)]
+    first_uid = api.engine.unit_count
+    api.map.spawn_units(spawns)
+    uids = np.arange(first_uid, api.engine.unit_count)
+    for uid in uids:
+        api.units[uid].setup()
+        api.units[uid].respawn()
+    return api, uids
+
+
+@benchmark
+def agency():
+    rows = []
+    for count in (25, 50, 100, 200):
+        api, uids = make_creep_wave(count)
+        units = [api.units[uid] for uid in uids]
+        def single():
+            for unit in units:
+                unit.passive_phase()
+                unit.action_phase()
+        single_time = timeit(single, repeat=10)
+        batch_time = timeit(lambda: type(units[0]).batch_action_phase(api.engine, uids), repeat=10)
+        rows.append((count, single_time, batch_time, single_time / batch_time))
+    report('Creep agency (ms)', ('creeps', 'single', 'batch', 'speedup'), rows)
+
+
+@benchmark
+def ability_state():
+    from collections import defaultdict
+    from logic.abilities import ABILITIES, ABILITY_STATE
+    from logic.units import StateTable
+    lookups = 10_000
+    abilities = [ABILITIES[i % len(ABILITIES)] for i in range(lookups)]
+    # Previous per unit state, keyed by formatted ability repr
+    cache = defaultdict(lambda: None)
+    def keyed():
+        for ability in abilities:
+            cache[f'{ability}-selected']
+            cache[f'{ability}-loadcount']
+    state = StateTable(ABILITY_STATE, len(ABILITIES))
+    def table():
+        for ability in abilities:
+            state.selected[ability.aid]
+            state.loadcount[ability.aid]
+    keyed_time = timeit(keyed)
+    table_time = timeit(table)
+    rows = [(lookups, keyed_time, table_time, keyed_time / table_time)]
+    report('Ability state lookups, selected+loadcount (ms)', ('lookups', 'keyed', 'table', 'speedup'), rows)
+
+
+@benchmark
+def timers():
+    from nutil.time import RateCounter
+    from logic.headless import make_encounter
+    engine = make_encounter(seed=0).engine
+    # Time only the dispatch of agent actions, not the actions themselves
+    engine._do_agent_action_phase = lambda uid: None
+    uids = np.arange(engine.unit_count).repeat(1000)
+    rate_counters = {'single': RateCounter(), 'agency': RateCounter()}
+    def previous():
+        for uid in uids:
+            with rate_counters['single'].time_block:
+                with rate_counters['agency'].time_block:
+                    engine._do_agent_action_phase(uid)
+    def dispatch():
+        for uid in uids:
+            engine._agent_action_phase(uid)
+    previous_time = timeit(previous, repeat=5)
+    engine.set_timers(True)
+    enabled = timeit(dispatch, repeat=5)
+    engine.set_timers(False)
+    disabled = timeit(dispatch, repeat=5)
+    rows = [(len(uids), previous_time, enabled, disabled)]
+    report('Agent action dispatch (ms)', ('actions', 'ratecounters', 'timers on', 'timers off'), rows)
+
+
+IMPORT_TIME_SCRIPT = """
+import sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - t0) * 1000
+heavy = [m for m in ('kivy', 'PIL') if m in sys.modules]
+print(elapsed, ','.join(heavy) or '-')
+"""
+
+
+@benchmark
+def imports():
+    rows = []
+    for module in ('logic.engine', 'logic.mechanics', 'logic.abilities',
+                   'logic.units', 'logic.mapgen', 'logic.encounter'):
+        times = []
+        for i in range(3):
+            output = subprocess.run(
+                [sys.executable, '-c', IMPORT_TIME_SCRIPT.format(module=module)],
+                capture_output=True, text=True, env=dict(os.environ, KIVY_NO_ARGS='1'),
+                ).stdout.split()
+            times.append(float(output[0]))
+        rows.append((module, min(times), output[1]))
+    report('Import time, fresh process (ms)', ('module', 'time', 'loads'), rows)
+
+
+def main(names):
+    logging.basicConfig(level=logging.ERROR)
+    names = names or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,32 @@
+"""
+Checkpoint files for running encounters.
+
+A checkpoint is a single uncompressed .npz file. Unit stats and the dmod
+pool are stored as arrays, and the remaining encounter state (units,
+visual effects, RNG) as a pickled blob in the "state" array.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import pickle
+import numpy as np
+
+
+CHECKPOINT_VERSION = 7
+
+
+def write_checkpoint(file, arrays, state):
+    state = dict(state, version=CHECKPOINT_VERSION)
+    blob = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    np.savez(file, state=np.frombuffer(blob, dtype=np.uint8), **arrays)
+    logger.info(f'Saved checkpoint: {file}')
+
+
+def read_checkpoint(file):
+    with np.load(file) as data:
+        arrays = {k: data[k] for k in data.files}
+    state = pickle.loads(arrays.pop('state').tobytes())
+    if state['version'] != CHECKPOINT_VERSION:
+        raise ValueError(f'Checkpoint {file} version {state["version"]} != {CHECKPOINT_VERSION}')
+    logger.info(f'Loaded checkpoint: {file}')
+    return arrays, state
@@ -3,6 +3,7 @@ logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
 
 import math
+import time
 import numpy as np
 from collections import defaultdict
 
@@ -12,7 +13,7 @@ from nutil.display import njoin, make_title
 from nutil.time import RateCounter, ping, pong, humanize_ms
 from nutil.file import file_load
 
-from data import DEV_BUILD, VERSION
+from data import DEV_BUILD, VERSION, ROOT_DIR
 from data.load import RDF
 from data.settings import PROFILE
 from data.assets import Assets
@@ -22,13 +23,17 @@ from gui.api import ControlEvent, InputEvent, CastEvent
 from logic.common import *
 
 from logic import MECHANICS_NAMES
-from logic.abilities import ABILITIES
+from logic.abilities import ABILITIES, PhasePlan, PassiveLedger
 from logic.engine import Engine as EncounterEngine
 from logic.mechanics import Mechanics
 from logic.mapgen import MapGenerator, MAP_DATA
+from logic.units import CamperTable
 from logic.items import ITEM, ITEMS, ITEM_CATEGORIES, Item
+from logic.checkpoint import write_checkpoint, read_checkpoint
+from logic.replay import ReplayRecorder
 
 
+REPLAY_DIR = ROOT_DIR / 'replays'
 metagame_data = str(VERSION) + str(DEV_BUILD) + ''.join(str(RDF.from_file(RDF.CONFIG_DIR / f'{_}.rdf').raw_dict) for _ in (
     'abilities', 'items', 'units',
 )) + str(MAP_DATA)
@@ -110,7 +115,7 @@ class EncounterAPI:
     view_offset = None
     view_size = gui_size = np.array([1024, 768])
 
-    def __init__(self, game, encounter_params, player_abilities):
+    def __init__(self, game, encounter_params, player_abilities, seed=None, checkpoint=None):
         self.debug_mode = False
         self.settings_notifier = PublishSubscribe(name='ELogic')
 
@@ -118,10 +123,23 @@ class EncounterAPI:
         self.game = game
         self.encounter_params = encounter_params
         self.difficulty_level = encounter_params.difficulty
+        # All randomness in the encounter is drawn from a single stream,
+        # such that an encounter is reproducible from its seed
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.rng = np.random.default_rng(self.seed)
+        logger.info(f'Encounter seed: {self.seed}')
+        self.replay_recorder = None
+        if checkpoint is None and PROFILE.get_setting('misc.record_replays'):
+            self.replay_recorder = ReplayRecorder(encounter_params, self.seed, player_abilities)
         self.engine = EncounterEngine(self)
-        self.map = MapGenerator(self, encounter_params)
+        self.campers = CamperTable()
+        self.passives = PassiveLedger()
+        self.map = MapGenerator(self, encounter_params, spawn=checkpoint is None)
+        if checkpoint is not None:
+            self._load_checkpoint(*checkpoint)
         self.player = self.units[self.player_uid]
-        self.player.set_abilities(player_abilities)
+        if checkpoint is None:
+            self.player.set_abilities(player_abilities)
         self.always_visible = np.zeros(len(self.engine.units), dtype=np.bool)
         self.always_active = np.zeros(len(self.engine.units), dtype=np.bool)
 
@@ -137,17 +155,68 @@ class EncounterAPI:
         self.settings_notifier.subscribe('misc.log_interval', self.setting_log_interval)
         self.settings_notifier.subscribe('misc.auto_log', self.setting_log_interval)
         self.setting_log_interval()
+        self.settings_notifier.subscribe('misc.collision_broadphase_min', self.setting_collision_broadphase)
+        self.setting_collision_broadphase()
+        self.settings_notifier.subscribe('misc.agency_budget', self.setting_agency_budget)
+        self.setting_agency_budget()
+        self.settings_notifier.subscribe('misc.spatial_index_min', self.setting_spatial_index)
+        self.setting_spatial_index()
+        self.settings_notifier.subscribe('misc.phase_plan_stats', self.setting_phase_plan_stats)
+        self.setting_phase_plan_stats()
         hotkeys = self.setting_hotkeys()
         for hk in hotkeys:
             self.settings_notifier.subscribe(hk, self.setting_hotkeys)
 
         # Setup units
-        self.engine.set_stats(self.player_uid, STAT.STOCKS, DIFFICULTY2STOCKS[self.difficulty_level])
+        if checkpoint is None:
+            self.engine.set_stats(self.player_uid, STAT.STOCKS, DIFFICULTY2STOCKS[self.difficulty_level])
         for unit in self.engine.units:
-            unit.action_phase()
+            if checkpoint is None:
+                unit.action_phase()
             self.always_visible[unit.uid] = unit.always_visible
             self.always_active[unit.uid] = unit.always_active
 
+    # Checkpoints
+    @classmethod
+    def from_checkpoint(cls, game, file):
+        arrays, state = read_checkpoint(file)
+        return cls(game, state['params'], None, seed=state['seed'], checkpoint=(arrays, state))
+
+    def save_checkpoint(self, file):
+        arrays, engine_state = self.engine.get_checkpoint()
+        state = {
+            'params': self.encounter_params,
+            'seed': self.seed,
+            'rng': self.rng.bit_generator.state,
+            'engine': engine_state,
+            'units': [(unit.unit_type, unit.get_state()) for unit in self.units],
+            'campers': self.campers,
+            'passives': self.passives,
+            'selected_unit': self.selected_unit,
+            'enc_over': self.enc_over,
+            'win': self.win,
+        }
+        write_checkpoint(file, arrays, state)
+
+    def _load_checkpoint(self, arrays, state):
+        self.map.restore_units([unit_type for unit_type, unit_state in state['units']], arrays['table'])
+        self.engine.load_checkpoint(arrays, state['engine'])
+        for unit, (unit_type, unit_state) in zip(self.units, state['units']):
+            unit.set_state(unit_state)
+        self.rng.bit_generator.state = state['rng']
+        self.campers = state['campers']
+        self.passives = state['passives']
+        self.selected_unit = state['selected_unit']
+        self.enc_over = state['enc_over']
+        self.win = state['win']
+
+    # Replays
+    def save_replay(self, file=None):
+        if file is None:
+            REPLAY_DIR.mkdir(exist_ok=True)
+            file = REPLAY_DIR / f'{time.strftime("%Y%m%d-%H%M%S")}-{self.encounter_params.map}.npz'
+        self.replay_recorder.save(file)
+
     def setting_feedback_sfx_interval(self):
         self.__feedback_sfx_interval = PROFILE.get_setting('audio.feedback_sfx_cooldown')
 
@@ -155,6 +224,19 @@ class EncounterAPI:
         self.__log_interval_ticks = PROFILE.get_setting('misc.log_interval')
         self.__last_log_interval = self.engine.tick - (self.__log_interval_ticks + 1)
 
+    def setting_collision_broadphase(self):
+        self.engine.stats.collision_broadphase_min = PROFILE.get_setting('misc.collision_broadphase_min')
+
+    def setting_agency_budget(self):
+        self.engine.agency.budget = int(PROFILE.get_setting('misc.agency_budget'))
+
+    def setting_spatial_index(self):
+        self.engine.stats.spatial_index_min = PROFILE.get_setting('misc.spatial_index_min')
+
+    def setting_phase_plan_stats(self):
+        PhasePlan.instrument = PROFILE.get_setting('misc.phase_plan_stats')
+        PhasePlan.reset_stats()
+
     def setup(self, interface):
         self.gui = interface
         self.settings_notifier.subscribe('ui.detailed_mode', self.setting_detailed_mode)
@@ -178,16 +260,24 @@ class EncounterAPI:
                 l.append(str(key).upper())
         return hotkeys
 
-    def update(self):
+    def update(self, ticks=None):
         with self.engine.total_timers['logic_total'].time_block:
             self.gui_size = self.gui.request('get_gui_size')
             self.view_size = self.gui_size * self.upp
 
             if not self.enc_over:
                 player_action_radius = min(self.units[0].view_distance+1000, 3000)
-                in_action_radius = self.engine.get_distances(self.engine.get_position(0)) < player_action_radius
+                participating = self.engine.stats.participating
+                player_distances = np.full(self.unit_count, np.inf)
+                player_distances[participating] = self.engine.get_distances(self.engine.get_position(0), participating)
+                in_action_radius = player_distances < player_action_radius
                 active_uids = self.always_active | in_action_radius
-                self.engine.update(active_uids)
+                agency_tiers = self.engine.agency.make_tiers(
+                    active_uids, player_distances, self.campers.engaged_mask(self.unit_count))
+                last_tick = self.engine.tick
+                self.engine.update(active_uids, ticks, agency_tiers)
+                if self.replay_recorder is not None:
+                    self.replay_recorder.record_frame(self.engine.tick - last_tick)
                 if self.__last_log_interval + self.__log_interval_ticks < self.engine.tick:
                     self.log_player_state()
                     self.__last_log_interval = self.engine.tick
@@ -258,6 +348,8 @@ class EncounterAPI:
 
     def leave(self):
         self.enc_over = True
+        if self.replay_recorder is not None:
+            self.save_replay()
         return self.win, self.encounter_params
 
     def end_encounter(self, win):
@@ -283,10 +375,8 @@ class EncounterAPI:
 
     def map_select(self, target):
         play_sfx = False
-        distances = self.engine.get_distances(target)
-        uid = NP.argmin(distances, self.sprite_visible_mask)
-        dist = distances[uid]
-        if dist < 50 * self.upp:
+        uid, dist = self.engine.nearest(target, self.sprite_visible_mask)
+        if uid is not None and dist < 50 * self.upp:
             play_sfx = True
         else:
             uid = 0
@@ -420,6 +510,7 @@ class EncounterAPI:
     def setting_debug_mode(self):
         debug_mode_setting = PROFILE.get_setting('misc.debug_mode')
         self.debug_mode = debug_mode_setting and DEV_BUILD
+        self.engine.set_timers(self.debug_mode)
         logger.info(f'Toggle debug_mode, now: {self.debug_mode} (debug:{debug_mode_setting} dev_build:{DEV_BUILD})')
         self.gui.request('debug_show' if self.debug_mode else 'debug_hide')  # Toggle debug panels
 
@@ -733,12 +824,11 @@ class EncounterAPI:
         def display_timer_collection(collection):
             strs = []
             for tname, timer in collection.items():
-                if isinstance(timer, RateCounter):
-                    m = timer.mean_elapsed_ms
-                    if m > 0.5:
-                        strs.append(f'[b]{tname}: {m:.3f} ms[/b]')
-                    else:
-                        strs.append(f'{tname}: {m:.3f} ms')
+                m = timer.mean_elapsed_ms
+                if m > 0.5:
+                    strs.append(f'[b]{tname}: {m:.3f} ms[/b]')
+                else:
+                    strs.append(f'{tname}: {m:.3f} ms')
             return '\n'.join(strs)
 
         verbose = True
@@ -748,6 +838,12 @@ class EncounterAPI:
             make_title('Single', length=30),
             display_timer_collection(self.engine.single_timers),
         ])
+        if PhasePlan.instrument:
+            logic_performance = '\n'.join([
+                logic_performance,
+                make_title('Phase Plans', length=30),
+                PhasePlan.debug_str(),
+            ])
 
         if not self.detailed_info_mode:
             return [logic_performance]
@@ -757,7 +853,8 @@ class EncounterAPI:
             f'Game time: {self.time_str}',
             f'Tick: {self.engine.tick} +{TPS} t/s',
             f'Map size: {self.map_size}',
-            f'Agency phase: {self.engine.tick % self.engine.AGENCY_PHASE_COUNT}',
+            make_title(f'Agency', length=30),
+            self.engine.agency.debug_str(),
             make_title(f'Stats Engine Debug', length=30),
             f'{self.engine.stats.debug_str(verbose=verbose)}',
         ])
@@ -802,6 +899,8 @@ class EncounterAPI:
         if self.gui.request('menu_showing') and event.name != 'toggle_menu':
             self.play_feedback(FAIL_RESULT.INACTIVE)
             return
+        if self.replay_recorder is not None:
+            self.replay_recorder.record_event(self.engine.tick, event)
         if isinstance(event, CastEvent):
             self.__handle_cast(event)
             return
@@ -852,6 +951,7 @@ class EncounterAPI:
             gdelta = self.engine.get_position(self.player_uid) == self.player.grave_pos
             if gdelta.sum() == 2:
                 self.player.move_to_spawn()
+                self.engine.set_participating(self.player_uid)
             else:
                 self.player.move_to_graveyard()
 
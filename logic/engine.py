@@ -4,21 +4,30 @@ logger = logging.getLogger(__name__)
 
 
 import copy
+import math
+import heapq
 import numpy as np
 from collections import defaultdict
 from nutil.vars import NP, nsign_str
-from nutil.time import ping, pong, RateCounter, pingpong, ratecounter
+from nutil.time import ping, pong, pingpong, Timers, NULL_TIMERS
 from nutil.random import Seed
 from nutil.display import nprint
 
 from logic.common import *
+from logic.spatial import SpatialGrid
 
 
-DMOD_CACHE_SIZE = 1000
+DMOD_POOL_MIN = 64
+UNIT_CAPACITY_MIN = 64
+COOLDOWN_COLUMNS_MIN = 16
 COLLISION_PASSES = 1
 COLLISION_DEFAULT = True
+COLLISION_BROADPHASE_MIN = 300
+AGENCY_BUDGET = 20
+SPATIAL_INDEX_MIN = 4000
 assert STAT.POS_Y == STAT.POS_X + 1
 POS = (STAT.POS_X, STAT.POS_Y)
+SPATIAL_STATS = (*POS, STAT.HITBOX)
 
 
 class Engine:
@@ -27,18 +36,18 @@ class Engine:
     def __init__(self, logic):
         # Variable initialization
         self.logic = logic
-        self.__seed = Seed()
+        self.__seed = Seed(logic.seed)
         self.eid = self.__seed.r
-        self.total_timers = defaultdict(RateCounter)
-        self.single_timers = defaultdict(RateCounter)
-        self.agency_timers = defaultdict(lambda: RateCounter(sample_size=10))
-        self.ability_timers = defaultdict(lambda: RateCounter(sample_size=10))
+        self.__timers = {name: Timers() for name in ('total', 'single', 'agency', 'ability')}
+        self.set_timers(False)
         self.auto_tick = True
         self.ticktime = 1000 / TPS
         self.__t0 = self.__last_tick = ping()
         self.stats = UnitStats()
+        self.agency = AgencyScheduler()
         self.units = []
         self.__active_uids = np.array([])
+        self.__agency_tiers = np.array([], dtype=np.int64)
         self._visual_effects = []
         logger.info(f'Initialized Encounter Engine {self}')
 
@@ -47,14 +56,23 @@ class Engine:
         return self.__active_uids
 
     # TIME MANAGEMENT
-    def update(self, active_uids):
+    def update(self, active_uids, ticks=None, agency_tiers=None):
+        """
+        Advance the engine. If ticks is None, the number of ticks is
+        determined by the time elapsed since the last tick. Agency tiers
+        are the AgencyScheduler tier of each unit, by default all active
+        units are in the near tier.
+        """
         assert isinstance(active_uids, np.ndarray)
         assert len(active_uids) == self.unit_count
         self.__active_uids = active_uids
+        if agency_tiers is None:
+            agency_tiers = self.agency.default_tiers(active_uids)
+        self.__agency_tiers = agency_tiers
         if self.tick == 0:
             logger.info(f'Encounter {self.eid} started.')
-            ticks = 1
-        ticks = self._check_ticks()
+        if ticks is None:
+            ticks = self._check_ticks()
         if ticks > self.AGENCY_PHASE_COUNT:
             logger.info(f'Requested {ticks} ticks on a single frame, throttled to {self.AGENCY_PHASE_COUNT}.')
             ticks = self.AGENCY_PHASE_COUNT
@@ -104,39 +122,40 @@ class Engine:
     def _do_agency(self, ticks):
         if ticks == 0:
             return
-        # find which uids are in action based on phase
         alive = self.stats.get_stats(slice(None), STAT.HP, VALUE.CURRENT) > 0
-        in_phase = alive & self._find_units_in_phase(ticks)
-        in_action_uids = np.flatnonzero(in_phase & self.__active_uids)
+        in_action_uids = self.agency.schedule(self.tick, ticks, self.__agency_tiers, alive)
         if len(in_action_uids) == 0: return
+        with self.single_timers['passive-stat-balance'].time_block:
+            self.logic.passives.balance(self, in_action_uids)
+        batches = defaultdict(list)
         for uid in in_action_uids:
-            with self.single_timers['agency'].time_block:
-                with self.agency_timers[uid].time_block:
-                    self._do_agent_action_phase(uid)
+            batch_key = self.units[uid].batch_agency
+            if batch_key is not None:
+                batches[batch_key].append(uid)
+                continue
+            self._agent_action_phase(uid)
+        for uids in batches.values():
+            with self.single_timers['agency-batch'].time_block:
+                type(self.units[uids[0]]).batch_action_phase(self, np.array(uids))
 
     def _do_agent_action_phase(self, uid):
         self.units[uid].passive_phase()
         self.units[uid].action_phase()
 
-    def _find_units_in_phase(self, ticks):
-        if ticks > self.AGENCY_PHASE_COUNT:
-            # Without crashing, assume tick count is lower than phase count
-            # This will not break the engine, but may cause game mechanics to break
-            # Better to adjust the phase count or improve performance of game mechanics,
-            # than to try and overcompute with an FPS deficiency
-            logger.critical(f'Running at extremely low logic update/agency phase count ratio (requested to produce {ticks} ticks worth of agency using only {self.AGENCY_PHASE_COUNT} phases). Things are breaking.')
-
-        # find which uids have agency in the given tick window
-        phase_first = (self.tick - ticks + 1) % self.AGENCY_PHASE_COUNT
-        phase_last = (self.tick) % self.AGENCY_PHASE_COUNT
-        unit_agency_phases = np.arange(self.unit_count) % self.AGENCY_PHASE_COUNT
-        if ticks == 1:
-            return unit_agency_phases == phase_last
-        # unit's phase must be between first and last (logical and)
-        if phase_first < phase_last:
-            return (phase_first <= unit_agency_phases) & (unit_agency_phases <= phase_last)
-        # unless we wrapped around from phase count to 0 (logical or)
-        return (phase_first <= unit_agency_phases) | (unit_agency_phases <= phase_last)
+    def _timed_agent_action_phase(self, uid):
+        with self.single_timers['agency'].time_block, self.agency_timers[uid].time_block:
+            self._do_agent_action_phase(uid)
+
+    def set_timers(self, enabled):
+        """
+        Enable or disable the performance timers. When disabled, the timer
+        collections are NULL_TIMERS which record nothing, and units act
+        without being timed at all. Recorded times are kept while disabled.
+        """
+        self.timers_enabled = enabled
+        for name, timers in self.__timers.items():
+            setattr(self, f'{name}_timers', timers if enabled else NULL_TIMERS)
+        self._agent_action_phase = self._timed_agent_action_phase if enabled else self._do_agent_action_phase
 
     @property
     def tick(self):
@@ -160,10 +179,32 @@ class Engine:
         assert unit.uid == index == len(self.units)
         self.units.append(unit)
 
+    def add_units(self, units, stats):
+        indices = self.stats.add_units(stats)
+        assert [u.uid for u in units] == list(indices)
+        assert indices[0] == len(self.units)
+        self.units.extend(units)
+
     @property
     def unit_count(self):
         return len(self.units)
 
+    # CHECKPOINT
+    def get_checkpoint(self):
+        arrays = self.stats.get_checkpoint()
+        state = {
+            'visual_effects': self._visual_effects,
+            'auto_tick': self.auto_tick,
+            'agency': self.agency,
+        }
+        return arrays, state
+
+    def load_checkpoint(self, arrays, state):
+        self.stats.load_checkpoint(arrays)
+        self._visual_effects = state['visual_effects']
+        self.set_auto_tick(state['auto_tick'])
+        self.agency = state['agency']
+
     # UTILITY
     def add_visual_effect(self, *args, **kwargs):
         self._visual_effects.append(VisualEffect(*args, **kwargs))
@@ -212,6 +253,10 @@ class Engine:
     def set_cooldown(self):
         return self.stats.set_cooldown
 
+    @property
+    def add_cooldown(self):
+        return self.stats.add_cooldown
+
     @property
     def get_position(self):
         return self.stats.get_position
@@ -258,21 +303,38 @@ class Engine:
     def mask_dead(self):
         return np.invert(self.mask_alive())
 
+    @property
+    def value_memo(self):
+        return self.stats.value_memo
+
+    @property
+    def nearest(self):
+        return self.stats.nearest
+
+    @property
+    def within_radius(self):
+        return self.stats.within_radius
+
+    @property
+    def intersecting_rect(self):
+        return self.stats.intersecting_rect
+
     def nearest_uid(self, point, mask=None, alive_only=True):
-        if mask is None:
-            mask = np.ones(len(self.units), dtype=np.bool)
         if alive_only:
-            mask = np.logical_and(mask, self.get_stats(slice(None), STAT.HP) > 0)
-        if mask.sum() == 0:
-            return None, None
-        distances = self.stats.get_distances(point)
-        uid = NP.argmin(distances, mask)
-        return uid, distances[uid]
+            uids = self.stats.participating
+            alive_mask = np.zeros(self.unit_count, dtype=np.bool)
+            alive_mask[uids[self.get_stats(uids, STAT.HP) > 0]] = True
+            mask = alive_mask if mask is None else alive_mask & mask
+        return self.stats.nearest(point, mask)
 
     @property
     def set_collision(self):
         return self.stats.set_collision
 
+    @property
+    def set_participating(self):
+        return self.stats.set_participating
+
     @property
     def add_dmod(self):
         return self.stats.add_dmod
@@ -282,6 +344,119 @@ class Engine:
         return self.stats.get_stats(slice(None), STAT.WEIGHT) < 0
 
 
+class AgencyScheduler:
+    """
+    Decides which units act on every frame, by level of detail. Units are
+    assigned a tier every frame (see make_tiers), and act once every
+    interval ticks of their tier: on the ticks where (tick - uid) is a
+    multiple of the interval, to spread units evenly over ticks. Dormant
+    units never act.
+
+    At most budget units act per tick (unlimited if not positive). Units
+    that are due beyond the budget are deferred to the next frame. The
+    longest overdue units act first, such that deferred units of any tier
+    are never starved.
+    """
+    TIERS = ('combat', 'near', 'dormant')
+    COMBAT, NEAR, DORMANT = range(len(TIERS))
+    INTERVALS = np.array([10, 30, 0])
+    COMBAT_RADIUS = 1000
+    REPORT_TICKS = TPS * 5
+    # Ticks passed to passive abilities of units the scheduler has not seen
+    DEFAULT_DT = 30
+
+    def __init__(self):
+        self.budget = AGENCY_BUDGET
+        self.tiers = np.zeros(0, dtype=np.int64)
+        # Tick on which each unit acts next, or -1 if not scheduled
+        self.next_due = np.zeros(0, dtype=np.int64)
+        # Ticks until the next action of each unit, since it last acted
+        self.dt = np.zeros(0, dtype=np.int64)
+        self.deferred = 0
+        self.rates = np.zeros(len(self.TIERS))
+        self.__acted = np.zeros(len(self.TIERS))
+        self.__unit_ticks = np.zeros(len(self.TIERS))
+        self.__report_ticks = 0
+
+    def make_tiers(self, active, distances, engaged):
+        """
+        Return the tier of every unit, from the active mask, distances to
+        the player and mask of units engaged with the player (see
+        CamperTable.engaged_mask). Active units are near, unless engaged or
+        within the combat radius of the player.
+        """
+        tiers = np.full(len(active), self.NEAR)
+        tiers[engaged | (distances < self.COMBAT_RADIUS)] = self.COMBAT
+        tiers[~active] = self.DORMANT
+        return tiers
+
+    def default_tiers(self, active):
+        return np.where(active, self.NEAR, self.DORMANT)
+
+    @staticmethod
+    def _next_aligned(tick, uids, intervals):
+        return tick + (uids - tick) % intervals
+
+    def schedule(self, tick, ticks, tiers, alive):
+        """Return the uids that act on the frame of ticks ending at tick."""
+        count = len(tiers)
+        if len(self.next_due) < count:
+            missing = count - len(self.next_due)
+            self.next_due = np.concatenate([self.next_due, np.full(missing, -1)])
+            self.dt = np.concatenate([self.dt, np.zeros(missing, dtype=np.int64)])
+        # Dead units are dormant
+        self.tiers = tiers = np.where(alive, tiers, self.DORMANT)
+        intervals = self.INTERVALS[tiers]
+        waiting = tiers == self.DORMANT
+        self.next_due[waiting] = -1
+        # Units that were waiting act on their first aligned tick of this frame
+        unscheduled = np.flatnonzero(~waiting & (self.next_due < 0))
+        self.next_due[unscheduled] = self._next_aligned(
+            tick - ticks + 1, unscheduled, intervals[unscheduled])
+        due = np.flatnonzero(~waiting & (self.next_due <= tick))
+        budget = self.budget * ticks
+        self.deferred = max(0, len(due) - budget) if budget > 0 else 0
+        if self.deferred:
+            priority = np.lexsort((due, tiers[due], self.next_due[due]))
+            due = np.sort(due[priority[:budget]])
+        next_due = self._next_aligned(tick + 1, due, intervals[due])
+        self.dt[due] = next_due - self.next_due[due]
+        self.next_due[due] = next_due
+        self._count_rates(ticks, tiers, due)
+        return due
+
+    def _count_rates(self, ticks, tiers, due):
+        tier_count = len(self.TIERS)
+        self.__acted += np.bincount(tiers[due], minlength=tier_count)
+        self.__unit_ticks += np.bincount(tiers, minlength=tier_count) * ticks
+        self.__report_ticks += ticks
+        if self.__report_ticks >= self.REPORT_TICKS:
+            self.rates = self.__acted / np.maximum(self.__unit_ticks, 1) * TPS
+            self.__acted[:] = 0
+            self.__unit_ticks[:] = 0
+            self.__report_ticks = 0
+
+    def unit_dt(self, uid):
+        """Ticks between the last and next action of uid."""
+        if uid >= len(self.dt) or self.dt[uid] == 0:
+            return self.DEFAULT_DT
+        return self.dt[uid]
+
+    def unit_str(self, uid):
+        if uid >= len(self.tiers):
+            return 'Agency: not scheduled'
+        return f'Agency: {self.TIERS[self.tiers[uid]]}, next at {self.next_due[uid]}'
+
+    def debug_str(self):
+        counts = np.bincount(self.tiers, minlength=len(self.TIERS))
+        strs = [f'Agency budget: {self.budget}/t ({self.deferred} deferred)']
+        for tier, name in enumerate(self.TIERS[:self.DORMANT]):
+            target = TPS / self.INTERVALS[tier]
+            strs.append(f'{name.capitalize()}: {counts[tier]} units, {self.rates[tier]:.2f}/s (target {target:.2f}/s)')
+        strs.append(f'Dormant: {counts[self.DORMANT]} units')
+        return '\n'.join(strs)
+
+
 class UnitStats:
     # STAT VALUES
     def get_stats(self, index, stat, value_name=None):
@@ -299,16 +474,36 @@ class UnitStats:
         elif multiplicative:
             stat_value *= cv
         self.table[index, stat, value_name] = stat_value
-        self._cap_minmax_values()
+        self.value_memo.clear()
+        self._cap_minmax_cells(index, stat)
+        if value_name == VALUE.CURRENT and self._is_spatial_stat(stat):
+            self._invalidate_distances()
+        elif value_name == VALUE.DELTA:
+            self._update_dynamic(index, stat)
+
+    def add_bonuses(self, uids, stats, values, deltas):
+        """
+        Add deltas to distinct (uid, stat, value) cells in one operation, as
+        set_stats with additive=True would for each cell.
+
+        :return:    Actual change of each cell, after capping
+        """
+        pre = self.table[uids, stats, values]
+        self.table[uids, stats, values] = pre + deltas
+        self.value_memo.clear()
+        self._cap_minmax_cells(uids, stats)
+        current = values == VALUE.CURRENT
+        if current.any() and self._is_spatial_stat(stats[current]):
+            self._invalidate_distances()
+        delta = values == VALUE.DELTA
+        if delta.any():
+            self._update_dynamic(uids[delta], stats[delta])
+        return self.table[uids, stats, values] - pre
 
     def get_dmod(self, index, stat=None):
-        active_dmods = (self._dmod_ticks > 0) & (self._dmod_targets[:, index] > 0)
-        if active_dmods.sum() == 0:
-            return 0
         if stat is None:
             stat = slice(None)
-        active_effects = self._dmod_effects_add[active_dmods, stat]
-        return np.sum(active_effects, axis=0)
+        return self._dmod_totals[index, stat]
 
     def get_delta_total(self, index, stat):
         return self.get_stats(index, stat, value_name=VALUE.DELTA) + self.get_dmod(index, stat)
@@ -318,8 +513,9 @@ class UnitStats:
         Get a status duration/stacks. Passing neither to value_name will return
         the stacks only if duration > 0.
         """
-        duration = self.status_table[index, status, STATUS_VALUE.DURATION]
-        amp = self.status_table[index, status, STATUS_VALUE.STACKS]
+        table = self.__status_table[:self.unit_count]
+        duration = table[index, status, STATUS_VALUE.DURATION] - self.tick
+        amp = table[index, status, STATUS_VALUE.STACKS]
         if value_name is STATUS_VALUE.DURATION:
             return duration
         elif value_name is STATUS_VALUE.STACKS:
@@ -329,16 +525,106 @@ class UnitStats:
         raise ValueError(f'get_status value_name {value_name} unrecognized')
 
     def set_status(self, index, status, duration, stacks):
-        self.status_table[index, status, STATUS_VALUE.DURATION] = duration
-        self.status_table[index, status, STATUS_VALUE.STACKS] = stacks
+        table = self.__status_table[:self.unit_count]
+        uids = self._index_uids(index)
+        previous = table[uids, status, STATUS_VALUE.DURATION]
+        table[index, status, STATUS_VALUE.DURATION] = self.tick + duration
+        table[index, status, STATUS_VALUE.STACKS] = stacks
+        self.value_memo.clear()
+        self._push_expiry(self.__status_expiry, uids, status,
+                          previous, table[uids, status, STATUS_VALUE.DURATION])
 
     def get_cooldown(self, index, ability=None):
         if ability is None:
-            ability = slice(None)
-        return self.cooldowns[index, ability]
+            return self.cooldowns[index]
+        if not isinstance(index, (int, np.integer)):
+            return np.array([self.get_cooldown(uid, ability) for uid in self._index_uids(index)])
+        column = self._cooldown_columns[index].get(ability)
+        if column is None:
+            return 0
+        return self.__cooldowns[index, column] - self.tick
 
     def set_cooldown(self, index, ability, value):
-        self.cooldowns[index, ability] = value
+        if not isinstance(index, (int, np.integer)):
+            uids = self._index_uids(index)
+            for uid, v in zip(uids, np.broadcast_to(value, uids.shape)):
+                self.set_cooldown(uid, ability, v)
+            return
+        column = self.add_cooldown(index, ability)
+        previous = self.__cooldowns[index, column]
+        self.__cooldowns[index, column] = self.tick + value
+        self._push_expiry(self.__cooldown_expiry, index, column, previous, self.__cooldowns[index, column])
+
+    def add_cooldown(self, index, ability):
+        """
+        Add a cooldown column for an ability to a unit (if missing), and
+        return the column. Cooldowns are stored in a compact table with
+        a column for each cooldown a unit has, see _cooldown_columns.
+        """
+        columns = self._cooldown_columns[index]
+        if ability not in columns:
+            column = len(columns)
+            if column >= self.__cooldowns.shape[1]:
+                self.__cooldowns = self._grow(self.__cooldowns, column * 2, axis=1)
+            columns[ability] = column
+            self._cooldown_aids[index].append(ability)
+            self.__cooldowns[index, column] = self.tick
+        return columns[ability]
+
+    # EXPIRY
+    # Status durations and cooldowns are stored as the tick on which they
+    # end, and read as the ticks remaining until then. Values that are set
+    # to end after the current tick are pushed to a min-heap of (expiry
+    # tick, uid, column), so that finding those that reach zero on a tick
+    # only pops the due entries instead of scanning the tables. Entries are
+    # not removed when a value is set again, and are instead dropped when
+    # popped if their expiry no longer matches the table.
+    def _index_uids(self, index):
+        if isinstance(index, (int, np.integer)):
+            return index
+        return np.arange(self.unit_count)[index]
+
+    def _push_expiry(self, heap, uids, column, previous, ends):
+        if np.ndim(ends) == 0:
+            expiry = math.ceil(ends)
+            # Skip if already scheduled for the same expiry
+            if ends > self.tick and not (previous > self.tick and math.ceil(previous) == expiry):
+                heapq.heappush(heap, (expiry, int(uids), int(column)))
+            return
+        expiries = np.ceil(ends)
+        scheduled = (previous > self.tick) & (np.ceil(previous) == expiries)
+        push = (ends > self.tick) & ~scheduled
+        for uid, expiry in zip(uids[push].tolist(), expiries[push].tolist()):
+            heapq.heappush(heap, (int(expiry), uid, int(column)))
+
+    def _pop_expired(self, heap, ends, ticks):
+        """
+        Pop the entries due by this tick, and return the (uid, column)
+        pairs of the values that reached zero during the last ticks, sorted.
+        Entries of values that were set again since they were pushed are
+        dropped, the values have a newer entry if they are still running.
+        """
+        expired = set()
+        while heap and heap[0][0] <= self.tick:
+            expiry, uid, column = heapq.heappop(heap)
+            end = ends[uid, column]
+            if math.ceil(end) != expiry or end <= self.tick - ticks:
+                continue
+            expired.add((uid, column))
+        return np.array(sorted(expired), dtype=np.int64).reshape(-1, 2)
+
+    def _rebuild_expiry(self):
+        self.__status_expiry = []
+        self.__cooldown_expiry = []
+        tables = (
+            (self.__status_expiry, self.__status_table[:self.unit_count, :, STATUS_VALUE.DURATION]),
+            (self.__cooldown_expiry, self.__cooldowns[:self.unit_count]),
+        )
+        for heap, ends in tables:
+            uids, columns = np.nonzero(ends > self.tick)
+            for uid, column, end in zip(uids.tolist(), columns.tolist(), ends[uids, columns].tolist()):
+                heap.append((math.ceil(end), uid, column))
+            heapq.heapify(heap)
 
     # SPECIAL VALUES
     def get_positions(self, index=None, value_name=None):
@@ -355,13 +641,18 @@ class UnitStats:
     def set_positions(self, index, pos, value_name=None):
         if value_name is None:
             value_name = VALUE.CURRENT
+        if value_name == VALUE.CURRENT:
+            self._invalidate_distances()
         if index is None:
-            self.table[slice(None), POS, value_name] = pos
+            index = slice(None)
         elif isinstance(index, np.ndarray):
             if index.dtype == np.bool:
                 index = np.flatnonzero(index)
             index = index[:, None]
         self.table[index, POS, value_name] = pos
+        self.value_memo.clear()
+        if value_name == VALUE.DELTA:
+            self._update_dynamic(index, POS)
 
     def get_position(self, index=None, value_name=None):
         if index is None:
@@ -373,7 +664,12 @@ class UnitStats:
     def set_position(self, index, pos, value_name=None):
         if value_name is None:
             value_name = VALUE.CURRENT
+        if value_name == VALUE.CURRENT:
+            self._invalidate_distances()
         self.table[index, (STAT.POS_X, STAT.POS_Y), value_name] = pos
+        self.value_memo.clear()
+        if value_name == VALUE.DELTA:
+            self._update_dynamic(index, POS)
 
     def get_velocity(self, index=None):
         if index is None:
@@ -419,14 +715,13 @@ class UnitStats:
         self.set_positions(np.flatnonzero(mask)[do_move], delta, value_name=VALUE.DELTA)
 
     def get_distances(self, point, index=None, include_hitbox=True):
-        if isinstance(index, int) or isinstance(index, np.int):
+        if isinstance(index, (int, np.integer)):
             _ = np.zeros(len(self.table), dtype=np.bool)
             _[index] = True
             index = _
         elif index is None:
             index = np.ones(len(self.table), dtype=np.bool)
-        positions = np.column_stack([self.table[index, a, VALUE.CURRENT] for a in (STAT.POS_X, STAT.POS_Y)])
-        dist = np.linalg.norm(positions - np.array(point), axis=-1)
+        dist = self._cached_distances(point)[index]
         if include_hitbox is True:
             dist -= self.table[index, STAT.HITBOX, VALUE.CURRENT]
             if isinstance(dist, np.ndarray):
@@ -439,8 +734,13 @@ class UnitStats:
         position = self.table[index1, (STAT.POS_X, STAT.POS_Y), VALUE.CURRENT]
         if index2 is None:
             index2 = slice(None)
-        positions = self.table[index2, (STAT.POS_X, STAT.POS_Y), VALUE.CURRENT]
-        dist = np.linalg.norm(position - positions, axis=-1)
+        if position.ndim == 1:
+            dist = self._cached_distances(position)[index2]
+            if isinstance(index2, slice):
+                dist = dist.copy()
+        else:
+            positions = self.table[index2, (STAT.POS_X, STAT.POS_Y), VALUE.CURRENT]
+            dist = np.linalg.norm(position - positions, axis=-1)
         if include_hitbox is True:
             dist -= self.table[index1, STAT.HITBOX, VALUE.CURRENT]
             dist -= self.table[index2, STAT.HITBOX, VALUE.CURRENT]
@@ -450,103 +750,370 @@ class UnitStats:
                 dist = 0
         return dist
 
+    # SPATIAL QUERIES
+    # Queries over the units in a mask, answered from a SpatialGrid that is
+    # rebuilt on the first query after any position or hitbox change. Below
+    # spatial_index_min units, queries scan all units instead. Results are
+    # identical either way.
+    def nearest(self, point, mask=None):
+        """Nearest uid in mask to point and its distance, or (None, None)."""
+        if self.unit_count < self.spatial_index_min:
+            uids = np.arange(self.unit_count) if mask is None else np.flatnonzero(mask)
+            if len(uids) == 0:
+                return None, None
+            distances = self.get_distances(point, uids)
+            nearest = distances.argmin()
+            return uids[nearest], distances[nearest]
+        return self._spatial_grid().nearest(point, self._query_mask(mask))
+
+    def within_radius(self, point, radius, mask=None):
+        """Sorted uids in mask whose distance to point is less than radius."""
+        if self.unit_count < self.spatial_index_min:
+            uids = np.arange(self.unit_count) if mask is None else np.flatnonzero(mask)
+            return uids[self.get_distances(point, uids) < radius]
+        return self._spatial_grid().within_radius(point, radius, self._query_mask(mask))
+
+    def intersecting_rect(self, rect, mask=None):
+        """Sorted uids in mask whose hitbox collides with rect (see Rect)."""
+        if self.unit_count < self.spatial_index_min:
+            uids = np.arange(self.unit_count) if mask is None else np.flatnonzero(mask)
+            positions = self.table[uids, STAT.POS_X:STAT.POS_Y+1, VALUE.CURRENT]
+            hitboxes = self.table[uids, STAT.HITBOX, VALUE.CURRENT]
+            return uids[rect.check_colliding_circles(positions, hitboxes)]
+        return self._spatial_grid().intersecting_rect(rect, self._query_mask(mask))
+
+    def _query_mask(self, mask):
+        if mask is None:
+            return np.ones(self.unit_count, dtype=np.bool)
+        return mask
+
+    def _spatial_grid(self):
+        if self.__spatial_grid is None:
+            positions = np.column_stack([self.table[:, a, VALUE.CURRENT] for a in POS])
+            self.__spatial_grid = SpatialGrid(positions, self.table[:, STAT.HITBOX, VALUE.CURRENT].copy())
+        return self.__spatial_grid
+
+    # DISTANCE CACHE
+    # Distances from a point to all units are cached by point until the
+    # next position write or tick. Rows are shared by all queries from the
+    # same point, e.g. unit_distance from a unit and get_distances from
+    # its position.
+    def _cached_distances(self, point):
+        if self.__distance_cache is None:
+            self.__cached_positions = np.column_stack([self.table[:, a, VALUE.CURRENT] for a in POS])
+            self.__distance_cache = {}
+        key = float(point[0]), float(point[1])
+        dist = self.__distance_cache.get(key)
+        if dist is None:
+            self.distance_cache_misses += 1
+            dist = np.linalg.norm(self.__cached_positions - np.array(point), axis=-1)
+            self.__distance_cache[key] = dist
+        else:
+            self.distance_cache_hits += 1
+        return dist
+
+    def _invalidate_distances(self):
+        self.__distance_cache = None
+        self.__spatial_grid = None
+
+    @staticmethod
+    def _is_spatial_stat(stat):
+        if isinstance(stat, slice):
+            return True
+        if isinstance(stat, (int, np.integer)):
+            return stat in SPATIAL_STATS
+        return any(s in SPATIAL_STATS for s in stat)
+
+    def set_participating(self, index, participating=True):
+        """
+        Set if units take part in physics (movement and collision) and
+        spatial queries of living units. Units stop participating when
+        their hp reaches zero, and must be set to participate again when
+        they respawn.
+        """
+        self.__participating[index] = participating
+        self.__participating_index = None
+        self.__dynamic_cells = None
+
+    @property
+    def participating(self):
+        """Array of participating uids, see set_participating."""
+        if self.__participating_index is None:
+            self.__participating_index = np.flatnonzero(self.__participating[:self.unit_count])
+        return self.__participating_index
+
+    # Stat cells with a nonzero delta or dmod total are dynamic, and are
+    # the only cells that the integrator needs to update.
+    def _update_dynamic(self, index, stat):
+        if isinstance(index, (int, np.integer)) and isinstance(stat, (int, np.integer)):
+            dynamic = self.__table[index, stat, VALUE.DELTA] != 0 or self.__dmod_totals[index, stat] != 0
+            if dynamic != self.__dynamic[index, stat]:
+                self.__dynamic[index, stat] = dynamic
+                self.__dynamic_cells = None
+            return
+        dynamic = (self.table[index, stat, VALUE.DELTA] != 0) | (self._dmod_totals[index, stat] != 0)
+        if np.any(dynamic != self._dynamic[index, stat]):
+            self._dynamic[index, stat] = dynamic
+            self.__dynamic_cells = None
+
+    def _rebuild_dynamic(self):
+        self._dynamic[:] = (self.table[:, :, VALUE.DELTA] != 0) | (self._dmod_totals != 0)
+        self.__dynamic_cells = None
+
+    @property
+    def _dynamic(self):
+        return self.__dynamic[:self.unit_count]
+
+    @property
+    def _dynamic_cells(self):
+        """Uids and stats of the dynamic cells of participating units."""
+        if self.__dynamic_cells is None:
+            rows = self.participating
+            row_index, stats = np.nonzero(self._dynamic[rows])
+            self.__dynamic_cells = rows[row_index], stats
+        return self.__dynamic_cells
+
     def set_collision(self, index, colliding=True):
         self._collision_flags[index] = colliding
 
     # ADD/REMOVE UNIT STATS
     def add_unit(self, unit_stats=None):
-        # Base stats entry
-        logger.debug(f'Adding new unit stats: {unit_stats}')
         if unit_stats is None:
-            unit_stats = np.zeros(self.table.shape[1:])
-        unit_stats = unit_stats[np.newaxis, :, :]
-        self.table = np.concatenate((self.table, unit_stats), axis=0)
-        # Dmod entry
-        new_column = np.zeros((DMOD_CACHE_SIZE, 1))
-        self._dmod_targets = np.concatenate((self._dmod_targets, new_column), axis=1)
-        # Status entry
-        unit_status = np.zeros((1, self.status_count, self.status_values_count))
-        unit_status[:, :, STATUS_VALUE.DURATION] = -1
-        self.status_table = np.concatenate((self.status_table, unit_status), axis=0)
-        # Cooldowns entry
-        unit_cooldowns = np.zeros((1, self.ability_count))
-        self.cooldowns = np.concatenate((self.cooldowns, unit_cooldowns), axis=0)
-        # Live flag
-        self._flags_alive = np.append(self._flags_alive, [False])
-        self._collision_flags = np.append(self._collision_flags, [COLLISION_DEFAULT])
-        assert len(self.table) == len(self.status_table) == len(self.cooldowns) == self._dmod_targets.shape[1] == len(self._flags_alive) == len(self._collision_flags)
-        return len(self.table) - 1
+            unit_stats = np.zeros((self.stat_count, self.values_count))
+        return self.add_units(unit_stats[np.newaxis, :, :])[0]
+
+    def add_units(self, stats_matrix):
+        """
+        Add the stats of multiple units in one operation.
+
+        :param stats_matrix:    Array of shape (units, stats, values)
+        :return:                Array of the new indices
+        """
+        logger.debug(f'Adding {len(stats_matrix)} new unit stats')
+        first = self.unit_count
+        last = first + len(stats_matrix)
+        self._ensure_capacity(last)
+        self.__table[first:last] = stats_matrix
+        self.__status_table[first:last] = 0
+        self.__status_table[first:last, :, STATUS_VALUE.DURATION] = self.tick - 1
+        self.__cooldowns[first:last] = self.tick
+        self._cooldown_columns.extend({} for uid in range(first, last))
+        self._cooldown_aids.extend([] for uid in range(first, last))
+        self.__flags_alive[first:last] = False
+        self.__collision_flags[first:last] = COLLISION_DEFAULT
+        self.__participating[first:last] = True
+        self.__participating_index = None
+        self.__dmod_totals[first:last] = 0
+        self.__dmod_counts[first:last] = 0
+        self.unit_count = last
+        self._rebuild_dynamic()
+        self._invalidate_distances()
+        self.value_memo.clear()
+        return np.arange(first, last)
+
+    def _ensure_capacity(self, count):
+        if count <= self.capacity:
+            return
+        capacity = max(self.capacity, UNIT_CAPACITY_MIN)
+        while capacity < count:
+            capacity *= 2
+        logger.debug(f'Growing unit stats capacity: {self.capacity} -> {capacity}')
+        self.__table = self._grow(self.__table, capacity)
+        self.__status_table = self._grow(self.__status_table, capacity)
+        self.__cooldowns = self._grow(self.__cooldowns, capacity)
+        self.__flags_alive = self._grow(self.__flags_alive, capacity)
+        self.__collision_flags = self._grow(self.__collision_flags, capacity)
+        self.__participating = self._grow(self.__participating, capacity)
+        self.__dynamic = self._grow(self.__dynamic, capacity)
+        self.__dmod_totals = self._grow(self.__dmod_totals, capacity)
+        self.__dmod_counts = self._grow(self.__dmod_counts, capacity)
+        self.capacity = capacity
+
+    def _grow(self, array, capacity, axis=0):
+        shape = list(array.shape)
+        shape[axis] = capacity
+        new_array = np.zeros(shape, dtype=array.dtype)
+        index = [slice(None)] * len(shape)
+        index[axis] = slice(0, self.unit_count if axis == 0 else array.shape[axis])
+        new_array[tuple(index)] = array[tuple(index)]
+        return new_array
+
+    # Views of the active prefix of each table
+    @property
+    def table(self):
+        return self.__table[:self.unit_count]
+
+    @table.setter
+    def table(self, value):
+        self.__table[:self.unit_count] = value
+        self._invalidate_distances()
+        self.value_memo.clear()
+        self._rebuild_dynamic()
+
+    @property
+    def status_table(self):
+        """Copy of the status table with remaining durations, see EXPIRY."""
+        table = self.__status_table[:self.unit_count].copy()
+        table[:, :, STATUS_VALUE.DURATION] -= self.tick
+        return table
+
+    @status_table.setter
+    def status_table(self, value):
+        self.__status_table[:self.unit_count] = value
+        self.__status_table[:self.unit_count, :, STATUS_VALUE.DURATION] += self.tick
+        self.value_memo.clear()
+        self._rebuild_expiry()
+
+    @property
+    def cooldowns(self):
+        """Cooldowns of all abilities, expanded from the compact table."""
+        cooldowns = np.zeros((self.unit_count, self.ability_count))
+        for uid, aids in enumerate(self._cooldown_aids):
+            cooldowns[uid, aids] = self.__cooldowns[uid, :len(aids)] - self.tick
+        return cooldowns
+
+    @property
+    def _compact_cooldowns(self):
+        return self.__cooldowns[:self.unit_count] - self.tick
+
+    @property
+    def _dmod_totals(self):
+        return self.__dmod_totals[:self.unit_count]
+
+    @property
+    def _dmod_counts(self):
+        return self.__dmod_counts[:self.unit_count]
+
+    @property
+    def _flags_alive(self):
+        return self.__flags_alive[:self.unit_count]
+
+    @_flags_alive.setter
+    def _flags_alive(self, value):
+        self.__flags_alive[:self.unit_count] = value
+
+    @property
+    def _collision_flags(self):
+        return self.__collision_flags[:self.unit_count]
+
+    @_collision_flags.setter
+    def _collision_flags(self, value):
+        self.__collision_flags[:self.unit_count] = value
 
     def add_dmod(self, ticks, units, stat, delta):
         if units.sum() == 0:
             return
         logger.debug(f'Adding dmod. ticks: {ticks}, stat: {stat.name}, delta: {delta}, units: {np.flatnonzero(units)}')
-        i = self._dmod_index % DMOD_CACHE_SIZE
-        self._dmod_effects_add[i, stat] = delta
+        if not self._dmod_free:
+            self._grow_dmod_pool()
+        i = self._dmod_free.pop()
+        self._dmod_stats[i] = stat
+        self._dmod_effects[i] = delta
         self._dmod_ticks[i] = ticks
-        self._dmod_targets[i] = units
-        self._dmod_index += 1
+        self._dmod_targets[i] = np.flatnonzero(units)
+        self._add_dmod_totals(i, self._dmod_targets[i], 1)
+        self._dmod_pairs_cache = None
         return i
 
+    def _add_dmod_totals(self, slot, uids, sign):
+        """Add (sign=1) or remove (sign=-1) a dmod from the running totals."""
+        stat = self._dmod_stats[slot]
+        self._dmod_totals[uids, stat] += self._dmod_effects[slot] * sign
+        self._dmod_counts[uids, stat] += sign
+        # Avoid accumulating float errors when no dmods remain
+        empty = uids[self._dmod_counts[uids, stat] == 0]
+        self._dmod_totals[empty, stat] = 0
+        self._update_dynamic(uids, stat)
+
+    def _grow_dmod_pool(self):
+        old_size = len(self._dmod_ticks)
+        size = max(old_size * 2, DMOD_POOL_MIN)
+        logger.debug(f'Growing dmod pool: {old_size} -> {size}')
+        self._dmod_stats = np.concatenate((self._dmod_stats, np.zeros(size - old_size, dtype=np.int64)))
+        self._dmod_effects = np.concatenate((self._dmod_effects, np.zeros(size - old_size)))
+        self._dmod_ticks = np.concatenate((self._dmod_ticks, np.zeros(size - old_size)))
+        self._dmod_targets.extend([None] * (size - old_size))
+        # Pop from the end, such that lower slots are reused first
+        self._dmod_free.extend(reversed(range(old_size, size)))
+
+    def _free_dmods(self, slots):
+        for i in slots:
+            self._add_dmod_totals(i, self._dmod_targets[i], -1)
+            self._dmod_ticks[i] = 0
+            self._dmod_targets[i] = None
+            self._dmod_free.append(i)
+        self._dmod_pairs_cache = None
+
+    def _dmod_pairs(self):
+        """
+        Return the (slot, uid) pairs of all active dmods, as two flat
+        arrays. Cached until a dmod is added or removed.
+        """
+        if self._dmod_pairs_cache is None:
+            active = np.flatnonzero(self._dmod_ticks > 0)
+            targets = [self._dmod_targets[i] for i in active]
+            counts = np.array([len(t) for t in targets], dtype=np.int64)
+            slots = np.repeat(active, counts)
+            uids = np.concatenate(targets) if targets else np.array([], dtype=np.int64)
+            self._dmod_pairs_cache = slots, uids
+        return self._dmod_pairs_cache
+
     def kill_statuses(self, index):
-        actives = self.status_table[index, :, STATUS_VALUE.DURATION] > 0
-        self.status_table[index, actives, STATUS_VALUE.DURATION] = 0
+        table = self.__status_table[:self.unit_count]
+        table[index, :, STATUS_VALUE.DURATION] = np.minimum(table[index, :, STATUS_VALUE.DURATION], self.tick)
+        self.value_memo.clear()
 
     def kill_dmods(self, index):
-        self._dmod_targets[:, index] = 0
+        slots, uids = self._dmod_pairs()
+        emptied = []
+        for i in np.unique(slots[uids == index]):
+            targets = self._dmod_targets[i]
+            self._add_dmod_totals(i, np.array([index]), -1)
+            self._dmod_targets[i] = targets = targets[targets != index]
+            if len(targets) == 0:
+                emptied.append(i)
+        self._free_dmods(emptied)
 
     # TICK
     def do_tick(self, ticks):
         self.tick += ticks
+        self._invalidate_distances()
+        self.value_memo.clear()
         hp_zero = self._do_stat_deltas(ticks)
+        if len(hp_zero) > 0:
+            self.set_participating(hp_zero, False)
         for _ in range(COLLISION_PASSES):
             self._collision_push()
         status_zero = self._do_status_deltas(ticks)
         cooldown_zero = self._do_cooldown_deltas(ticks)
         return hp_zero, status_zero, cooldown_zero
 
-    def _dmod_deltas(self):
-        active_dmods = self._dmod_ticks > 0
-        active_targets = self._dmod_targets[active_dmods]
-        active_effects_add = self._dmod_effects_add[active_dmods]
-        # Reshape targets and effects and compare
-        active_targets = active_targets[:, :, np.newaxis]
-        active_effects_add = active_effects_add[:, np.newaxis, :]
-        dmod_add = active_targets * active_effects_add
-        delta_add = np.sum(dmod_add, axis=0)
-        return delta_add
-
     def _do_stat_deltas(self, ticks):
-        current_values = self.table[:, :, VALUE.CURRENT]
+        uids, stats = self._dynamic_cells
+        cells = self.table[uids, stats]
+        current_values = cells[:, VALUE.CURRENT]
+        target_values = cells[:, VALUE.TARGET]
         # Find deltas
-        deltas = self.table[:, :, VALUE.DELTA] * ticks
-        active_dmods = self._dmod_ticks > 0
-        dmod_count = active_dmods.sum()
-        if dmod_count > 0:
-            delta_add = self._dmod_deltas() * ticks
-            deltas = copy.copy(deltas) + delta_add
-            self._dmod_ticks -= ticks
-        live_units = self.table[:, STAT.HP, VALUE.CURRENT] > 0
-        deltas *= live_units.reshape(len(self.table), 1)
-
-        min_values = self.table[:, :, VALUE.MIN]
-        max_values = self.table[:, :, VALUE.MAX]
-        target_values = self.table[:, :, VALUE.TARGET]
-        target_value_diffs = target_values - current_values
+        deltas = cells[:, VALUE.DELTA] * ticks
+        active_dmods = np.flatnonzero(self._dmod_ticks > 0)
+        if len(active_dmods) > 0:
+            deltas += self._dmod_totals[uids, stats] * ticks
+            self._dmod_ticks[active_dmods] -= ticks
+            self._free_dmods(active_dmods[self._dmod_ticks[active_dmods] <= 0])
+        deltas *= self.table[uids, STAT.HP, VALUE.CURRENT] > 0
 
         # Find which values are changed by delta, and which reach their target
-        tv_same_direction = np.equal(np.greater_equal(target_value_diffs, 0), np.greater_equal(deltas, 0))
-        tv_smaller_than_delta = np.less_equal(np.abs(target_value_diffs), np.abs(deltas))
-        reaching_target = np.logical_and(tv_same_direction, tv_smaller_than_delta)
-        at_target = np.logical_or(reaching_target, np.equal(target_value_diffs, 0))
-        not_at_target = np.invert(at_target)
+        target_value_diffs = target_values - current_values
+        tv_same_direction = (target_value_diffs >= 0) == (deltas >= 0)
+        tv_smaller_than_delta = np.abs(target_value_diffs) <= np.abs(deltas)
+        at_target = (tv_same_direction & tv_smaller_than_delta) | (target_value_diffs == 0)
 
         # Add deltas or set at target
-        current_values[not_at_target] += deltas[not_at_target]
-        current_values[at_target] = target_values[at_target]
+        self.table[uids, stats, VALUE.CURRENT] = np.where(at_target, target_values, current_values + deltas)
 
         # Cap at min and max value
         self._cap_minmax_values()
+        self._invalidate_distances()
 
         # Return a list of units that reached 0 HP
         hp_below_zero = self.table[:, STAT.HP, VALUE.CURRENT] <= 0
@@ -554,6 +1121,14 @@ class UnitStats:
         self._flags_alive = np.invert(hp_below_zero)
         return hp_zero.nonzero()[0]
 
+    def _cap_minmax_cells(self, index, stat):
+        # Cap only the cells that were written, the full table is capped
+        # at the end of every tick
+        values = self.table[index, stat]
+        capped = np.minimum(np.maximum(
+            values[..., VALUE.CURRENT], values[..., VALUE.MIN]), values[..., VALUE.MAX])
+        self.table[index, stat, VALUE.CURRENT] = capped
+
     def _cap_minmax_values(self):
         current_values = self.table[:, :, VALUE.CURRENT]
         min_values = self.table[:, :, VALUE.MIN]
@@ -562,39 +1137,31 @@ class UnitStats:
         above_max_mask = current_values > max_values
         current_values[below_min_mask] = min_values[below_min_mask]
         current_values[above_max_mask] = max_values[above_max_mask]
+        self._invalidate_distances()
+        self.value_memo.clear()
 
     def _do_status_deltas(self, ticks):
-        already_at_zero = self.status_table[:, :, STATUS_VALUE.DURATION] <= 0
-        will_be_at_zero = self.status_table[:, :, STATUS_VALUE.DURATION] - ticks <= 0
-        reaching_zero_now = np.invert(already_at_zero) & will_be_at_zero
-        self.status_table[:, :, STATUS_VALUE.DURATION] -= ticks
-        return np.column_stack(reaching_zero_now.nonzero())
+        return self._pop_expired(self.__status_expiry, self.__status_table[:, :, STATUS_VALUE.DURATION], ticks)
 
     def _do_cooldown_deltas(self, ticks):
-        already_at_zero = self.cooldowns[:, :] <= 0
-        will_be_at_zero = self.cooldowns[:, :] - ticks <= 0
-        reaching_zero_now = np.invert(already_at_zero) & will_be_at_zero
-        self.cooldowns -= ticks
-        return np.column_stack(reaching_zero_now.nonzero())
+        cooldown_zero = self._pop_expired(self.__cooldown_expiry, self.__cooldowns, ticks)
+        if len(cooldown_zero) > 0:
+            cooldown_zero[:, 1] = [self._cooldown_aids[uid][column] for uid, column in cooldown_zero]
+            cooldown_zero = cooldown_zero[np.lexsort(cooldown_zero.T[::-1])]
+        return cooldown_zero
 
     def _collision_push(self):
-        # Get full distance table
-        hitboxes = self.table[:, STAT.HITBOX, VALUE.CURRENT]
-        combined_hitboxes = hitboxes + hitboxes.reshape(len(self.table), 1)
-        pos1 = self.table[:, (STAT.POS_X, STAT.POS_Y), VALUE.CURRENT]
-        pos2 = pos1[:, np.newaxis, :]
-        vectors = pos1 - pos2
-        # Find collisions (both ways, when u0 pushed u1, u1 also pushes u0)
-        distances = np.linalg.norm(vectors, axis=2)
-        overlap = (distances - combined_hitboxes) * -1
-        colliding = (overlap > 0) & (distances > 0)
-        # Ignore units colliding with themselves
-        colliding[np.identity(len(colliding), dtype=np.bool)] = False
-        colliding[:, self._collision_flags == False] = False
-        colliding[self._collision_flags == False, :] = False
-        pushing, pushed = np.nonzero(colliding)
+        colliders = self.participating[self._collision_flags[self.participating]]
+        if len(colliders) < 2:
+            return
+        if len(colliders) < self.collision_broadphase_min:
+            pairs = self._collision_pairs_dense(colliders)
+        else:
+            pairs = self._collision_pairs_grid(colliders)
+        pushing, pushed, vectors, distances, overlap = pairs
         if len(pushing) == 0:
             return
+        hitboxes = self.table[:, STAT.HITBOX, VALUE.CURRENT]
 
         # Find how heavy is the pushing unit
         push_weight = self.table[pushing, STAT.WEIGHT, VALUE.CURRENT]
@@ -611,8 +1178,8 @@ class UnitStats:
         # Push only enough to eliminate hitbox overlap
         # Also consider the relative weight, as we calculate eacg side pushing the other
         final_push_weight = push_weight / (push_weight + standing_weight)
-        push_distance = final_push_weight * overlap[pushing, pushed]
-        push_vectors = vectors[pushing, pushed] / distances[pushing, pushed, np.newaxis]
+        push_distance = final_push_weight * overlap
+        push_vectors = vectors / distances[:, np.newaxis]
         final_push_vectors = push_vectors * push_distance.reshape(len(push_distance), 1)
 
         # Update positions
@@ -621,6 +1188,68 @@ class UnitStats:
         self.set_positions(pushed, new_positions)
         self.align_to_target(self.mask(pushed))
 
+    def _collision_pairs_dense(self, colliders):
+        # Get full distance table of colliders
+        hitboxes = self.table[colliders, STAT.HITBOX, VALUE.CURRENT]
+        combined_hitboxes = hitboxes + hitboxes.reshape(len(colliders), 1)
+        pos1 = self.table[colliders][:, (STAT.POS_X, STAT.POS_Y), VALUE.CURRENT]
+        pos2 = pos1[:, np.newaxis, :]
+        vectors = pos1 - pos2
+        # Find collisions (both ways, when u0 pushed u1, u1 also pushes u0)
+        distances = np.linalg.norm(vectors, axis=2)
+        overlap = (distances - combined_hitboxes) * -1
+        colliding = (overlap > 0) & (distances > 0)
+        # Ignore units colliding with themselves
+        colliding[np.identity(len(colliding), dtype=bool)] = False
+        pushing, pushed = np.nonzero(colliding)
+        return (colliders[pushing], colliders[pushed], vectors[pushing, pushed],
+                distances[pushing, pushed], overlap[pushing, pushed])
+
+    def _collision_pairs_grid(self, colliders):
+        """
+        Spatial hash broadphase. Colliders are binned into square cells
+        at least as large as the largest combined hitbox, such that
+        colliding pairs are always in the same or adjacent cells.
+        Returns pairs in the same order as the dense method.
+        """
+        hitboxes = self.table[colliders, STAT.HITBOX, VALUE.CURRENT]
+        positions = self.table[colliders][:, (STAT.POS_X, STAT.POS_Y), VALUE.CURRENT]
+        cell_size = max(hitboxes.max() * 2, 1)
+        cells = np.floor(positions / cell_size).astype(np.int64)
+        cells -= cells.min(axis=0) - 1
+        row_size = cells[:, 1].max() + 2
+        keys = cells[:, 0] * row_size + cells[:, 1]
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        # Find all candidates from each of the 9 neighboring cells
+        unit_index = np.arange(len(colliders))
+        candidates_a, candidates_b = [], []
+        for offset_x in (-1, 0, 1):
+            for offset_y in (-1, 0, 1):
+                neighbor_keys = keys + offset_x * row_size + offset_y
+                starts = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+                ends = np.searchsorted(sorted_keys, neighbor_keys, side='right')
+                counts = ends - starts
+                total = counts.sum()
+                if total == 0:
+                    continue
+                a = np.repeat(unit_index, counts)
+                run_starts = np.cumsum(counts) - counts
+                b = np.arange(total) - np.repeat(run_starts, counts) + np.repeat(starts, counts)
+                candidates_a.append(a)
+                candidates_b.append(order[b])
+        a = np.concatenate(candidates_a)
+        b = np.concatenate(candidates_b)
+        # Narrowphase
+        vectors = positions[b] - positions[a]
+        distances = np.linalg.norm(vectors, axis=1)
+        overlap = (distances - (hitboxes[a] + hitboxes[b])) * -1
+        colliding = (overlap > 0) & (distances > 0) & (a != b)
+        pushing, pushed = colliders[a[colliding]], colliders[b[colliding]]
+        sort = np.lexsort((pushed, pushing))
+        return (pushing[sort], pushed[sort], vectors[colliding][sort],
+                distances[colliding][sort], overlap[colliding][sort])
+
     # INTERNAL
     def mask(self, index):
         a = np.full(len(self.table), False, dtype=np.bool)
@@ -629,33 +1258,142 @@ class UnitStats:
 
     def __init__(self):
         self.tick = 0
+        # All per-unit tables are preallocated with spare capacity, and
+        # grow by doubling. Only the first unit_count rows are live, and
+        # the public accessors are views of that prefix.
+        self.unit_count = 0
+        self.capacity = 0
+        # Number of colliding units from which collision uses the
+        # spatial hash broadphase instead of the full distance table
+        self.collision_broadphase_min = COLLISION_BROADPHASE_MIN
+        # Memo of formula values by (formula, uid), cleared by every write
+        # to stats or statuses and every tick (see Formula.get_value)
+        self.value_memo = {}
+        # Number of units from which spatial queries use a SpatialGrid
+        # instead of scanning all units
+        self.spatial_index_min = SPATIAL_INDEX_MIN
         # Base stats table, containing all stats and all values.
         # See STAT class and VALUE class.
         self.stat_count = len(STAT)
         self.values_count = len(VALUE)
-        self.table = np.zeros(
+        self.__table = np.zeros(
             shape=(0, self.stat_count, self.values_count),
             dtype=np.float64)
-        # Status table, containing all status durations and stacks.
+        # Status table, containing all status end ticks and stacks (see
+        # EXPIRY, status_table gives the durations).
         self.status_count = len(STATUS)
         self.status_values_count = len(STATUS_VALUE)
-        self.status_table = np.zeros(
+        self.__status_table = np.zeros(
             shape=(0, self.status_count, self.status_values_count),
             dtype=np.float64)
-        # Cooldown table contains a cooldown value (-1 per tick)
-        # For each ability
+        # Cooldown table contains the end tick of each cooldown of a
+        # unit (see EXPIRY). Columns are assigned per unit
+        # in _cooldown_columns (aid -> column), and _cooldown_aids
+        # lists the aids by column.
         self.ability_count = len(ABILITY)
-        self.cooldowns = np.zeros(shape=(0, self.ability_count))
+        self.__cooldowns = np.zeros(shape=(0, COOLDOWN_COLUMNS_MIN))
+        self._cooldown_columns = []
+        self._cooldown_aids = []
+        # Expiry heaps of statuses and cooldowns, see EXPIRY
+        self.__status_expiry = []
+        self.__cooldown_expiry = []
         # Delta modifier table contains temporary effects that can
         # add to each stat delta (without changing their source),
         # for a certain number of ticks.
-        self._dmod_index = 0
-        self._dmod_effects_add = np.zeros(
-            shape=(DMOD_CACHE_SIZE, self.stat_count), dtype=np.float64)
-        self._dmod_ticks = np.zeros(DMOD_CACHE_SIZE)
-        self._dmod_targets = np.zeros(shape=(DMOD_CACHE_SIZE, 0))
-        self._flags_alive = np.array([], dtype=np.bool)
-        self._collision_flags = np.array([], dtype=np.bool)
+        # Each dmod adds a delta to a single stat of its target units.
+        # Slots are allocated from a free list, and the pool grows
+        # when exhausted.
+        self._dmod_stats = np.zeros(0, dtype=np.int64)
+        self._dmod_effects = np.zeros(0)
+        self._dmod_ticks = np.zeros(0)
+        self._dmod_targets = []
+        self._dmod_free = []
+        self._dmod_pairs_cache = None
+        # Running sum of active dmods per unit and stat, maintained when
+        # dmods are added or removed, and the number of dmods in each sum
+        self.__dmod_totals = np.zeros((0, self.stat_count))
+        self.__dmod_counts = np.zeros((0, self.stat_count), dtype=np.int64)
+        self.__flags_alive = np.array([], dtype=np.bool)
+        self.__collision_flags = np.array([], dtype=np.bool)
+        # Units that take part in physics and spatial queries, see
+        # set_participating. The tables keep all units, dead or alive.
+        self.__participating = np.array([], dtype=bool)
+        self.__participating_index = None
+        # Dynamic stat cells, see _update_dynamic
+        self.__dynamic = np.zeros((0, self.stat_count), dtype=bool)
+        self.__dynamic_cells = None
+        # Distances, see _cached_distances
+        self.__distance_cache = None
+        self.__cached_positions = None
+        self.__spatial_grid = None
+        self.distance_cache_hits = 0
+        self.distance_cache_misses = 0
+
+    # CHECKPOINT
+    def get_checkpoint(self):
+        """Return a dictionary of arrays that fully represent the stats."""
+        targets = self._dmod_targets
+        target_counts = np.array([-1 if t is None else len(t) for t in targets], dtype=np.int64)
+        target_uids = [t for t in targets if t is not None]
+        return {
+            'tick': np.array(self.tick),
+            'table': self.table,
+            'status_table': self.status_table,
+            'cooldowns': self._compact_cooldowns,
+            'cooldown_aids': self._cooldown_aid_table(),
+            'flags_alive': self._flags_alive,
+            'collision_flags': self._collision_flags,
+            'participating': self.__participating[:self.unit_count],
+            'dmod_stats': self._dmod_stats,
+            'dmod_effects': self._dmod_effects,
+            'dmod_ticks': self._dmod_ticks,
+            'dmod_target_counts': target_counts,
+            'dmod_target_uids': np.concatenate(target_uids) if target_uids else np.array([], dtype=np.int64),
+            'dmod_free': np.array(self._dmod_free, dtype=np.int64),
+            'dmod_totals': self._dmod_totals,
+            'dmod_counts': self._dmod_counts,
+        }
+
+    def load_checkpoint(self, arrays):
+        """Load the arrays from get_checkpoint, units must be added already."""
+        assert len(arrays['table']) == self.unit_count
+        self.tick = int(arrays['tick'])
+        self.table = arrays['table']
+        self.status_table = arrays['status_table']
+        self._load_cooldowns(arrays['cooldowns'], arrays['cooldown_aids'])
+        self._flags_alive = arrays['flags_alive']
+        self._collision_flags = arrays['collision_flags']
+        self.set_participating(slice(0, self.unit_count), arrays['participating'])
+        self._dmod_stats = arrays['dmod_stats'].copy()
+        self._dmod_effects = arrays['dmod_effects'].copy()
+        self._dmod_ticks = arrays['dmod_ticks'].copy()
+        self._dmod_targets = []
+        uids = arrays['dmod_target_uids']
+        offset = 0
+        for count in arrays['dmod_target_counts']:
+            if count < 0:
+                self._dmod_targets.append(None)
+                continue
+            self._dmod_targets.append(uids[offset:offset+count].copy())
+            offset += count
+        self._dmod_free = arrays['dmod_free'].tolist()
+        self._dmod_totals[:] = arrays['dmod_totals']
+        self._dmod_counts[:] = arrays['dmod_counts']
+        self._dmod_pairs_cache = None
+        self._rebuild_dynamic()
+
+    def _cooldown_aid_table(self):
+        aids = np.full(self._compact_cooldowns.shape, -1, dtype=np.int64)
+        for uid, uid_aids in enumerate(self._cooldown_aids):
+            aids[uid, :len(uid_aids)] = uid_aids
+        return aids
+
+    def _load_cooldowns(self, cooldowns, aid_table):
+        self.__cooldowns = np.zeros((self.capacity, max(cooldowns.shape[1], COOLDOWN_COLUMNS_MIN)))
+        self.__cooldowns[:self.unit_count, :cooldowns.shape[1]] = cooldowns + self.tick
+        self._cooldown_aids = [[ABILITY(aid) for aid in aids if aid >= 0] for aids in aid_table]
+        self._cooldown_columns = [{aid: c for c, aid in enumerate(aids)} for aids in self._cooldown_aids]
+        self._rebuild_expiry()
 
     def print_table(self):
         with np.printoptions(precision=2, linewidth=10_000, threshold=10_000):
@@ -663,14 +1401,9 @@ class UnitStats:
             print(self.table.shape)
 
     def _dmod_repr(self, i):
-        deltas = self._dmod_effects_add[i]
-        active_deltas = np.flatnonzero(deltas)
-        delta_str = []
-        for stat_index in active_deltas:
-            stat_name = STAT_LIST[stat_index].name.lower()
-            delta_str.append(f'{stat_name}: {nsign_str(round(deltas[stat_index], 4))}')
-        delta_str = ', '.join(delta_str)
-        return f'<{i}> T-{self._dmod_ticks[i]}, targets: {np.flatnonzero(self._dmod_targets[i])}; {delta_str}'
+        stat_name = STAT_LIST[self._dmod_stats[i]].name.lower()
+        delta_str = f'{stat_name}: {nsign_str(round(self._dmod_effects[i], 4))}'
+        return f'<{i}> T-{self._dmod_ticks[i]}, targets: {self._dmod_targets[i]}; {delta_str}'
 
     def debug_str(self, verbose=False):
         active_dmods = np.flatnonzero(self._dmod_ticks > 0)
@@ -679,11 +1412,14 @@ class UnitStats:
         else:
             dmod_reprs = []
         return '\n'.join([
-            f'Main table: {self.table.shape}',
+            f'Main table: {self.table.shape} (capacity: {self.capacity})',
             f'Status table: {self.status_table.shape}',
-            f'Cooldown table: {self.cooldowns.shape}',
+            f'Cooldown table: {self._compact_cooldowns.shape} ({self.ability_count} abilities)',
+            f'Expiry heaps: {len(self.__status_expiry)} statuses, {len(self.__cooldown_expiry)} cooldowns',
             f'No collision units: {np.flatnonzero(self._collision_flags == 0)}',
-            f'Dmods: {self._dmod_effects_add.shape}',
+            f'Participating units: {len(self.participating)}',
+            f'Dmod pool: {len(self._dmod_ticks)} ({len(self._dmod_free)} free)',
+            f'Distance cache: {self.distance_cache_hits} hits, {self.distance_cache_misses} misses',
             f'Active dmods: {len(active_dmods)}',
             *dmod_reprs,
         ])
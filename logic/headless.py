@@ -0,0 +1,180 @@
+"""
+Run encounters without a GUI, as fast as possible.
+
+Usage: python -m logic.headless [map] [ticks] [difficulty] [seed] [ability ...]
+       python -m logic.headless --replay FILE
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import sys
+import time
+import numpy as np
+from collections import defaultdict
+
+from nutil.vars import Interface
+from nutil.display import make_title
+
+from data.assets import Assets
+from logic.common import *
+from logic.game import EncounterParams
+from logic.encounter import EncounterAPI
+from logic.replay import read_replay
+
+
+DEFAULT_MAP = 'Tripod'
+DEFAULT_LOADOUT = ('Attack', 'Blink', 'Fireblast', 'Bloodlust')
+
+
+class HeadlessInterface(Interface):
+    """
+    Stand-in for the GUI interface. Requests are counted and otherwise
+    ignored, except for queries that the encounter requires an answer to.
+    Set record to keep every request with its arguments.
+    """
+    def __init__(self, gui_size=(1024, 768), record=False):
+        super().__init__(name='Headless')
+        self.gui_size = np.array(gui_size)
+        self.record = record
+        self.recorded = []
+        self.request_counts = defaultdict(int)
+        self.__responses = {
+            'get_gui_size': lambda: self.gui_size,
+            'get_mouse_pos': lambda: (0, 0),
+            'menu_showing': lambda: False,
+            'browse_showing': lambda: False,
+        }
+
+    def register(self, callname, callback):
+        self.__responses[callname] = callback
+
+    def request(self, callname, *a, **k):
+        self.request_counts[callname] += 1
+        if self.record:
+            self.recorded.append((callname, a, k))
+        if callname in self.__responses:
+            return self.__responses[callname](*a, **k)
+
+
+def make_encounter(map_name=DEFAULT_MAP, difficulty=1, loadout=DEFAULT_LOADOUT,
+                   seed=None, interface=None, audio=False, timers=False):
+    """
+    Create an encounter and set it up with a headless interface.
+
+    :param map_name:    Name of map (see MAP_DATA)
+    :param difficulty:  Difficulty level (see DIFFICULTY_LEVELS)
+    :param loadout:     Ability names or ABILITY members, up to 8
+    :param seed:        Encounter seed, random if None
+    :param interface:   Interface to use, defaults to a new HeadlessInterface
+    :param audio:       Play sounds (requires an audio backend)
+    :param timers:      Enable the engine performance timers
+    :return:            EncounterAPI
+    """
+    Assets.audio_enabled = audio
+    params = EncounterParams(
+        replayable=True, silver_cost=0, map=map_name, difficulty=difficulty,
+        vp_reward=0, color=(1, 1, 1), sprite=None, description='Headless')
+    loadout = [a if a is None or isinstance(a, ABILITY) else str2ability(a) for a in loadout]
+    loadout += [None] * (8 - len(loadout))
+    api = EncounterAPI(None, params, loadout, seed=seed)
+    api.setup(HeadlessInterface() if interface is None else interface)
+    api.engine.set_timers(timers)
+    return api
+
+
+def run_ticks(api, ticks, frame_ticks=1):
+    """
+    Step the encounter for a number of ticks, without waiting for the
+    clock. Every frame runs frame_ticks ticks and a full logic update.
+
+    :return:    Number of ticks run, and elapsed time in seconds
+    """
+    start_tick = api.engine.tick
+    t0 = time.perf_counter()
+    while api.engine.tick - start_tick < ticks and not api.enc_over:
+        api.update(ticks=frame_ticks)
+    return api.engine.tick - start_tick, time.perf_counter() - t0
+
+
+def run_replay(replay, interface=None, timers=False):
+    """
+    Play a replay (see logic.replay) without waiting for the clock. Every
+    recorded frame is run with the same number of ticks, and events are
+    handled once the engine has reached the tick they were recorded at.
+
+    :param replay:      Replay or path to a replay file
+    :param interface:   Interface to use, defaults to a new HeadlessInterface
+    :param timers:      Enable the engine performance timers
+    :return:            EncounterAPI, and elapsed time in seconds
+    """
+    if not isinstance(replay, tuple):
+        replay = read_replay(replay)
+    Assets.audio_enabled = False
+    api = EncounterAPI(None, replay.params, replay.loadout, seed=replay.seed)
+    api.setup(HeadlessInterface() if interface is None else interface)
+    api.engine.set_timers(timers)
+    events = replay.events
+    next_event = 0
+
+    def handle_events():
+        nonlocal next_event
+        while next_event < len(events) and events[next_event][0] <= api.engine.tick:
+            api._handle_event(events[next_event][1])
+            next_event += 1
+
+    t0 = time.perf_counter()
+    handle_events()
+    for frame_ticks in replay.frames:
+        api.update(ticks=frame_ticks)
+        handle_events()
+    return api, time.perf_counter() - t0
+
+
+def timers_report(api):
+    def timer_collection(title, collection):
+        strs = [make_title(title, length=70), f'{"":<30}{"count":>8}{"mean ms":>10}{"max ms":>10}{"total ms":>12}']
+        for tname, timer in sorted(collection.items()):
+            strs.append(f'{tname:<30}{timer.count:>8}{timer.mean_elapsed_ms:>10.3f}{timer.max_ms:>10.3f}{timer.total_ms:>12.1f}')
+        return '\n'.join(strs)
+
+    return '\n'.join([
+        timer_collection('Logic Performance Totals', api.engine.total_timers),
+        timer_collection('Single', api.engine.single_timers),
+    ])
+
+
+def main_replay(file):
+    replay = read_replay(file)
+    api, elapsed = run_replay(replay, timers=True)
+    ticks = api.engine.tick
+    print(f'Replay: {file}, map: {replay.params.map}, seed: {replay.seed}, events: {len(replay.events)}')
+    print(f'Ran {ticks} ticks in {elapsed:.3f}s: {ticks / elapsed:.1f} ticks/s')
+    if api.enc_over:
+        print(f'Encounter over at tick {api.engine.tick}, win: {api.win}')
+    print(timers_report(api))
+
+
+def main(args):
+    logging.basicConfig(level=logging.ERROR)
+    if args[:1] == ['--replay']:
+        main_replay(args[1])
+        return
+    map_name = args[0] if len(args) > 0 else DEFAULT_MAP
+    ticks = int(args[1]) if len(args) > 1 else 3000
+    difficulty = int(args[2]) if len(args) > 2 else 1
+    seed = int(args[3]) if len(args) > 3 else None
+    loadout = args[4:] if len(args) > 4 else DEFAULT_LOADOUT
+    t0 = time.perf_counter()
+    api = make_encounter(map_name, difficulty, loadout, seed=seed, timers=True)
+    load_time = time.perf_counter() - t0
+    ticks_done, elapsed = run_ticks(api, ticks)
+    print(f'Map: {map_name}, difficulty: {difficulty}, seed: {api.seed}, units: {api.engine.unit_count}, loaded in {load_time:.3f}s')
+    print(f'Ran {ticks_done} ticks in {elapsed:.3f}s: {ticks_done / elapsed:.1f} ticks/s')
+    if api.enc_over:
+        print(f'Encounter over at tick {api.engine.tick}, win: {api.win}')
+    print(timers_report(api))
+    print(f'Kivy loaded: {"kivy" in sys.modules}, PIL loaded: {"PIL" in sys.modules}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -39,6 +39,9 @@ ITEM = AutoIntEnum('ITEM', [internal_name(name) for name in ALL_ITEM_NAMES])
 
 
 class Item:
+    # Per unit state fields and their defaults
+    STATE = {'buy_tick': None}
+
     def __init__(self, iid, name, raw_data):
         self.iid = iid
         self.name = name
@@ -129,7 +132,7 @@ class Item:
                 engine.set_stats(uid, stat_name, value, value_name=value_name, additive=True)
         result = self.iid
         logger.info(f'{unit.name} bought item: {self}')
-        engine.units[uid].cache[f'{self}-buy'] = engine.tick
+        engine.units[uid].item_state.buy_tick[self.iid] = engine.tick
         return result
 
     def sell_item(self, engine, uid):
@@ -143,7 +146,7 @@ class Item:
 
         unit.remove_item(self.iid)
 
-        buy_tick = engine.units[uid].cache[f'{self}-buy']
+        buy_tick = engine.units[uid].item_state.buy_tick[self.iid]
         sell_multi = 1 if engine.tick - buy_tick < QUICK_RESELL_WINDOW else self.sell_multi
         engine.set_stats(uid, STAT.GOLD, self.cost*sell_multi, additive=True)
         for stat_name, stat in self.stats.items():
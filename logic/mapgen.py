@@ -34,7 +34,7 @@ BIOME_TYPES = [
 
 
 class MapGenerator:
-    def __init__(self, api, encounter_params):
+    def __init__(self, api, encounter_params, spawn=True):
         self.api = api
         self.encounter_params = encounter_params
         self.map_name = self.encounter_params.map
@@ -45,9 +45,10 @@ class MapGenerator:
         self.spawns = []
         self.biomes = []
         self.generate_map()
-        self.spawn_map()
-        for unit in self.engine.units:
-            unit.setup()
+        if spawn:
+            self.spawn_map()
+            for unit in self.engine.units:
+                unit.setup()
 
     def setup(self, interface):
         self.gui = interface
@@ -80,7 +81,7 @@ class MapGenerator:
         assert 'Spawn' in spawn_data
         raw_player_spawn = spawn_data['Spawn']['loc'].positional[0]
         self.player_spawn = str2pos(raw_player_spawn) + 0.1
-        self.spawn_unit('player', self.player_spawn)
+        spawns = [('player', self.player_spawn)]
         for spawn_name, sdata in spawn_data.items():
             if 'loc' not in sdata:
                 raise CorruptedDataError(f'{spawn_name} missing locations!')
@@ -90,7 +91,26 @@ class MapGenerator:
                     raise CorruptedDataError(f'{spawn_name} missing units!')
                 for unit, count in sdata['units'].items():
                     for i in range(int(count)):
-                        self.spawn_unit(unit, pos)
+                        spawns.append((unit, pos))
+        self.spawn_units(spawns)
+
+    def spawn_units(self, spawns):
+        first_uid = self.engine.next_uid
+        units = []
+        for i, (unit_type, location) in enumerate(spawns):
+            unit = Unit.from_data(self.api, first_uid + i, unit_type)
+            unit.set_spawn_location(location)
+            units.append(unit)
+        stats = np.stack([unit.starting_stats for unit in units])
+        self.engine.add_units(units, stats)
+        logger.debug(f'Spawned {len(units)} new units')
+
+    def restore_units(self, unit_types, stats):
+        """Create units with existing stats, without setting them up."""
+        first_uid = self.engine.next_uid
+        units = [Unit.from_data(self.api, first_uid + i, unit_type) for i, unit_type in enumerate(unit_types)]
+        self.engine.add_units(units, stats)
+        logger.debug(f'Restored {len(units)} units')
 
     def spawn_unit(self, unit_type, location):
         uid = self.engine.next_uid
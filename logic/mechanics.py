@@ -245,72 +245,89 @@ class Mechanics:
         point[over] = map_size[over]
         return point
 
+    @staticmethod
+    def bound_to_map_batch(api, points):
+        points = np.array(points)
+        bounded = np.minimum(np.maximum(points, 0), np.array(api.map_size))
+        if PROFILE.get_setting('misc.debug_mode'):
+            unbounded = (points > -100_000).sum(axis=1) < 2
+            bounded[unbounded] = points[unbounded]
+        return bounded
+
 
 class Rect:
+    # Scratch buffers for check_colliding_circles, grown by doubling
+    _buffers = np.zeros((3, 64))
+
     @classmethod
     def from_point(cls, origin, target, width, height, offset=0):
-        direction_vector = target - origin
+        direction_vector = np.asarray(target - origin, dtype=np.float64)
         if direction_vector.sum() == 0:
-            direction_vector = [10, 10]
-        center_offset = normalize(direction_vector, height/2+offset+0.001)
-        rect_center = origin + center_offset
-        rotation = cls.find_vector_angle_radians(direction_vector)
-        return cls(rect_center, rotation, width, height)
-
-    def __init__(self, center, rotation, width, height):
+            direction_vector = np.array([10.0, 10.0])
+        direction = direction_vector / np.linalg.norm(direction_vector)
+        rect_center = origin + direction * (height/2+offset+0.001)
+        return cls(rect_center, None, width, height, direction=direction)
+
+    def __init__(self, center, rotation, width, height, direction=None):
+        """
+        Rotation is in radians, counter clockwise from the positive y
+        axis. Alternatively give the normalized direction vector along the
+        height of the rect (rotation is then ignored).
+        """
         self.center = center
-        self.rotation = rotation
         self.width = width
         self.height = height
-        self.point_vectors = np.array([
-            [-width/2, -height/2],  # bl
-            [width/2, -height/2],  # br
-            [width/2, height/2],  # tr
-            [-width/2, height/2],  # tl
-        ])
-        self.__rotated_points = self.rotated_points(rotation)
+        if direction is None:
+            self.cos, self.sin = math.cos(rotation), math.sin(rotation)
+        else:
+            self.cos, self.sin = float(direction[1]), float(direction[0])
+        self.half_diagonal = math.hypot(width, height) / 2
+        self.__points = None
+
+    @property
+    def rotation(self):
+        return math.atan2(self.sin, self.cos)
 
     def check_colliding_circles(self, p, circle_radius):
-        rx, ry = self.center
-        x, y = p[:, 0], p[:, 1]
-        # Rotate center of circle based on our rotation (makes for easier calc)
-        mc = math.cos(self.rotation)
-        ms = math.sin(self.rotation)
-        cx = (x - rx) * mc - (y - ry) * ms + self.width / 2
-        cy = (x - rx) * ms + (y - ry) * mc + self.height / 2
-        # Find the closest x point from center of circle
-        near_x = cx.copy()
-        near_x[cx < 0] = 0
-        near_x[cx > self.width] = self.width
-        # Find the closest y point from center of circle
-        near_y = cy.copy()
-        near_y[cy < 0] = 0
-        near_y[cy > self.height] = self.height
-        # Find distance from circle center to nearest point in the rectangle
-        p_ = np.stack((cx, cy), axis=1)
-        nearest = np.stack((near_x, near_y), axis=1)
-        distance_to_nearest = np.linalg.norm((p_ - nearest), axis=1)
+        p = np.asarray(p)
+        radii = np.broadcast_to(circle_radius, len(p))
+        dx = p[:, 0] - self.center[0]
+        dy = p[:, 1] - self.center[1]
+        colliding = np.zeros(len(p), dtype=np.bool)
+        # Cull circles that do not reach the bounding circle of the rect
+        reach = radii + self.half_diagonal
+        candidates = np.flatnonzero(dx * dx + dy * dy <= reach * reach)
+        if len(candidates) == 0:
+            return colliding
+        dx, dy, radii = dx[candidates], dy[candidates], radii[candidates]
+        if self._buffers.shape[1] < len(candidates):
+            Rect._buffers = np.zeros((3, 2 ** math.ceil(math.log2(len(candidates)))))
+        lx, ly, tmp = self._buffers[:, :len(candidates)]
+        # Rotate circle centers to rect coordinates (width along x)
+        np.multiply(dx, self.cos, out=lx)
+        np.multiply(dy, self.sin, out=tmp)
+        np.subtract(lx, tmp, out=lx)
+        np.multiply(dx, self.sin, out=ly)
+        np.multiply(dy, self.cos, out=tmp)
+        np.add(ly, tmp, out=ly)
+        # Distance from circle centers to the nearest point in the rect
+        np.abs(lx, out=lx)
+        np.subtract(lx, self.width / 2, out=lx)
+        np.maximum(lx, 0, out=lx)
+        np.abs(ly, out=ly)
+        np.subtract(ly, self.height / 2, out=ly)
+        np.maximum(ly, 0, out=ly)
+        np.hypot(lx, ly, out=lx)
         # Consider the circle's radius
-        return distance_to_nearest < circle_radius
+        colliding[candidates] = lx < radii
+        return colliding
 
     @property
     def points(self):
-        return self.__rotated_points
-
-    @classmethod
-    def find_vector_angle_radians(cls, direction_vector):
-        base = np.array([0.0, 1.0])
-        neg_x = direction_vector[0] < 0
-        v1u = direction_vector / np.linalg.norm(direction_vector)
-        v2u = base / np.linalg.norm(base)
-        radians = np.arccos(np.clip(np.dot(v1u, v2u), -1.0, 1.0))
-        radians *= -1 if neg_x else 1
-        return radians
-
-    def rotated_points(self, radians=0):
-        if radians == 0:
-            return self.point_vectors
-        c, s = np.cos(radians), np.sin(radians)
-        j = np.matrix([[c, s], [-s, c]])
-        rotated_point_vectors = np.vstack([np.hstack(np.dot(j, p).T) for p in self.point_vectors])
-        return rotated_point_vectors + self.center
+        """Corners (bl, br, tr, tl), computed on first access."""
+        if self.__points is None:
+            w, h = self.width / 2, self.height / 2
+            corners = np.array([[-w, -h], [w, -h], [w, h], [-w, h]])
+            c, s = self.cos, self.sin
+            self.__points = corners @ np.array([[c, -s], [s, c]]) + self.center
+        return self.__points
@@ -0,0 +1,72 @@
+"""
+Replay files for encounters.
+
+A replay records the encounter params, seed and loadout, the number of
+ticks run by every engine update, and every GUI event handled by the
+encounter stamped with the engine tick it was handled at. Since all
+randomness in an encounter is drawn from its seed, feeding the events
+back at the same ticks reproduces the encounter.
+
+Like checkpoints, a replay is a single .npz file: frame ticks are stored
+as an array and everything else as a pickled blob in the "state" array.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import pickle
+import numpy as np
+from collections import namedtuple
+
+from logic.common import *
+
+
+REPLAY_VERSION = 1
+Replay = namedtuple('Replay', ['params', 'seed', 'loadout', 'frames', 'events'])
+
+
+class ReplayRecorder:
+    def __init__(self, params, seed, loadout):
+        self.params = params
+        self.seed = seed
+        self.loadout = list(loadout)
+        self.frames = []
+        self.events = []
+
+    def record_frame(self, ticks):
+        if ticks > 0:
+            self.frames.append(ticks)
+
+    def record_event(self, tick, event):
+        self.events.append((tick, event))
+
+    @property
+    def replay(self):
+        return Replay(self.params, self.seed, self.loadout, self.frames, self.events)
+
+    def save(self, file):
+        write_replay(file, self.replay)
+
+
+def write_replay(file, replay):
+    state = {
+        'version': REPLAY_VERSION,
+        'params': replay.params,
+        'seed': replay.seed,
+        'loadout': [None if a is None else a.name for a in replay.loadout],
+        'events': replay.events,
+    }
+    blob = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    frames = np.asarray(replay.frames, dtype=np.uint16)
+    np.savez_compressed(file, state=np.frombuffer(blob, dtype=np.uint8), frames=frames)
+    logger.info(f'Saved replay: {file} ({len(frames)} frames, {len(replay.events)} events)')
+
+
+def read_replay(file):
+    with np.load(file) as data:
+        state = pickle.loads(data['state'].tobytes())
+        frames = data['frames'].astype(np.int64)
+    if state['version'] != REPLAY_VERSION:
+        raise ValueError(f'Replay {file} version {state["version"]} != {REPLAY_VERSION}')
+    logger.info(f'Loaded replay: {file}')
+    loadout = [None if a is None else ABILITY[a] for a in state['loadout']]
+    return Replay(state['params'], state['seed'], loadout, frames.tolist(), state['events'])
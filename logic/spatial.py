@@ -0,0 +1,93 @@
+"""
+Uniform grid spatial index of unit positions.
+
+Units are binned into square cells, and cells are sorted by key such that
+a column of cells is a single slice of the sorted units. Queries gather
+the candidates from the cells around the query, and then filter them
+with exactly the same distance and collision tests as a brute force scan
+over all units, so results are identical.
+
+Distances are to the edge of the unit hitboxes (clipped at 0), as in
+UnitStats.get_distances.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+
+SPATIAL_CELL_SIZE = 500
+
+
+class SpatialGrid:
+    def __init__(self, positions, hitboxes, cell_size=SPATIAL_CELL_SIZE):
+        self.positions = positions
+        self.hitboxes = hitboxes
+        self.cell_size = cell_size
+        self.max_hitbox = hitboxes.max() if len(hitboxes) > 0 else 0
+        cells = np.floor(positions / cell_size).astype(np.int64)
+        self.cell_min = cells.min(axis=0) if len(cells) > 0 else np.zeros(2, dtype=np.int64)
+        self.cell_max = cells.max(axis=0) if len(cells) > 0 else np.zeros(2, dtype=np.int64)
+        cells -= self.cell_min
+        self.row_size = self.cell_max[1] - self.cell_min[1] + 1
+        keys = cells[:, 0] * self.row_size + cells[:, 1]
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def distances(self, point, uids):
+        dist = np.linalg.norm(self.positions[uids] - np.array(point), axis=-1)
+        dist -= self.hitboxes[uids]
+        dist[dist < 0] = 0
+        return dist
+
+    def _block(self, point, reach):
+        """Uids (sorted) of all units in cells within reach of point."""
+        low = np.floor((np.array(point) - reach) / self.cell_size).astype(np.int64)
+        high = np.floor((np.array(point) + reach) / self.cell_size).astype(np.int64)
+        low = np.maximum(low, self.cell_min) - self.cell_min
+        high = np.minimum(high, self.cell_max) - self.cell_min
+        if (low > high).any():
+            return np.zeros(0, dtype=np.int64)
+        columns = np.arange(low[0], high[0] + 1) * self.row_size
+        starts = np.searchsorted(self.sorted_keys, columns + low[1], side='left')
+        ends = np.searchsorted(self.sorted_keys, columns + high[1], side='right')
+        uids = np.concatenate([self.order[s:e] for s, e in zip(starts, ends)])
+        return np.sort(uids)
+
+    def _covers_grid(self, point, reach):
+        low = np.floor((np.array(point) - reach) / self.cell_size)
+        high = np.floor((np.array(point) + reach) / self.cell_size)
+        return (low <= self.cell_min).all() and (high >= self.cell_max).all()
+
+    def nearest(self, point, mask):
+        """
+        Nearest uid in mask to point and its distance, or (None, None) if
+        mask is empty. The search reach doubles until the nearest candidate
+        is closer than any unit outside of the searched cells could be.
+        """
+        reach = self.cell_size
+        while True:
+            uids = self._block(point, reach)
+            uids = uids[mask[uids]]
+            if len(uids) > 0:
+                dist = self.distances(point, uids)
+                nearest = dist.argmin()
+                # Units outside the block are further than reach from point
+                if dist[nearest] < reach - self.max_hitbox or self._covers_grid(point, reach):
+                    return uids[nearest], dist[nearest]
+            elif self._covers_grid(point, reach):
+                return None, None
+            reach *= 2
+
+    def within_radius(self, point, radius, mask):
+        """Uids in mask whose distance to point is less than radius."""
+        uids = self._block(point, radius + self.max_hitbox)
+        uids = uids[mask[uids]]
+        return uids[self.distances(point, uids) < radius]
+
+    def intersecting_rect(self, rect, mask):
+        """Uids in mask whose hitbox circle collides with rect."""
+        reach = np.hypot(rect.width, rect.height) / 2 + self.max_hitbox
+        uids = self._block(rect.center, reach)
+        uids = uids[mask[uids]]
+        return uids[rect.check_colliding_circles(self.positions[uids], self.hitboxes[uids])]
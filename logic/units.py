@@ -9,7 +9,6 @@ import copy, random
 from nutil.vars import normalize, collide_point, is_iterable, List, nsign_str, nsign, FIFO
 from nutil.display import make_title
 from nutil.time import ratecounter
-from nutil.random import SEED
 from data import DEV_BUILD
 from data.load import RDF
 from data.assets import Assets
@@ -17,13 +16,15 @@ from data.settings import PROFILE
 
 from logic.common import *
 from logic.mechanics import Mechanics
-from logic.abilities import ABILITIES
-from logic.items import ITEMS, ITEM_CATEGORIES
-RNG = np.random.default_rng()
+from logic.abilities import ABILITIES, ABILITY_STATE
+from logic.items import ITEMS, ITEM_CATEGORIES, Item
 
 
 STARTING_PLAYER_STOCKS = 10
 GRAVEYARD_POSITION = np.array([-1_000_000, -1_000_000], dtype=np.float64)
+# Attributes that are references or are rebuilt from unit data, and are
+# not part of a unit's checkpoint state
+_NON_STATE_ATTRIBUTES = {'api', 'engine', 'rng', '_raw_data', 'p', 'regen_trackers'}
 
 
 class Slots:
@@ -103,6 +104,8 @@ class Unit:
     say = ''
     win_on_death = False
     lose_on_death = False
+    # Units with the same batch agency key act together (see batch_action_phase)
+    batch_agency = None
 
     @staticmethod
     def _get_default_stats():
@@ -152,19 +155,22 @@ class Unit:
 
     def __init__(self, api, uid, name, raw_data):
         self.__uid = uid
+        self.unit_type = name
         self._raw_data = raw_data
         self.p = raw_data.default
         raw_stats = raw_data['stats'] if 'stats' in raw_data else {}
         self.starting_stats = self._load_raw_stats(raw_stats)
         self.grave_offset = np.array([(self.uid%10)*300, (self.uid//10)*300], dtype=np.float64)
         self.grave_pos = GRAVEYARD_POSITION + self.grave_offset
-        self.cache = defaultdict(lambda: None)
+        self.ability_state = StateTable(ABILITY_STATE, len(ABILITIES))
+        self.item_state = StateTable(Item.STATE, len(ITEMS))
         self.always_visible = True if 'always_visible' in self.p.positional else False
         self.always_active = True if 'always_active' in self.p.positional else False
-        self.death_sfx = raw_data.default['death_sfx'] if 'death_sfx' in raw_data.default else f'ui.death-unit{RNG.integers(4)+1}'
+        self.death_sfx = raw_data.default['death_sfx'] if 'death_sfx' in raw_data.default else f'ui.death-unit{api.rng.integers(4)+1}'
         self.respawn_sfx = f'ui.{raw_data.default["respawn_sfx"]}' if 'respawn_sfx' in raw_data.default else 'ui.respawn-unit'
         self.api = api
         self.engine = api.engine
+        self.rng = api.rng
         self.name = raw_data.default['name'] if 'name' in raw_data.default else name
         sprite_name = raw_data.default['sprite'] if 'sprite' in raw_data.default else name
         self.sprite = Assets.get_sprite(f'units.{sprite_name}')
@@ -173,6 +179,7 @@ class Unit:
         self._ability_slots = Slots(8)
         self._item_slots = Slots(8)
         self.__item_aids = set()
+        self.__passive_aids = None
         self.off_cooldown_aids = defaultdict(set)
         self.builtin_walk = str2ability('Builtin Walk')
         self.builtin_loot = str2ability('Builtin Loot')
@@ -210,13 +217,16 @@ class Unit:
         if aid is None:
             return
         ability = self.api.abilities[aid]
+        self.__passive_aids = None
         self.off_cooldown_aids[ability.off_cooldown_aid].add(aid)
+        self.engine.add_cooldown(self.uid, ability.cooldown_aid)
         ability.load_on_unit(self.engine, self.uid)
 
     def _unload_ability(self, aid):
         if aid is None:
             return
         ability = self.api.abilities[aid]
+        self.__passive_aids = None
         self.off_cooldown_aids[ability.off_cooldown_aid].remove(aid)
         ability.unload_from_unit(self.engine, self.uid)
 
@@ -308,7 +318,7 @@ class Unit:
         if aid is not None:
             self.use_ability(aid, target, alt)
 
-    def use_ability(self, aid, target, alt=0):
+    def use_ability(self, aid, target, alt=0, nearest=None):
         if aid not in self.abilities:
             logger.warning(f'{self} using ability {repr(aid)} not in abilities: {self.abilities}')
         if not self.engine.auto_tick and not self.api.debug_mode:
@@ -321,7 +331,7 @@ class Unit:
             return
 
         ability = self.api.abilities[aid]
-        ability.active(self.engine, self.uid, target, alt)
+        ability.active(self.engine, self.uid, target, alt, nearest)
 
     def use_walk(self, target):
         self.use_ability(self.builtin_walk, target)
@@ -343,9 +353,17 @@ class Unit:
         pass
 
     def passive_phase(self):
-        paids = set(self.abilities) | set(ITEMS[iid].aid for iid in self.items) - {None}
-        for paid in paids:
-            ABILITIES[paid].passive(self.engine, self.uid, self.engine.AGENCY_PHASE_COUNT)
+        # Passive stat bonuses are balanced by the engine for all acting units
+        dt = self.engine.agency.unit_dt(self.uid)
+        for paid in self.passive_aids:
+            ABILITIES[paid].passive(self.engine, self.uid, dt)
+
+    @classmethod
+    def batch_action_phase(cls, engine, uids):
+        for uid in uids:
+            unit = engine.units[uid]
+            unit.passive_phase()
+            unit.action_phase()
 
     def off_cooldown(self, aid):
         if not self.is_alive:
@@ -358,6 +376,13 @@ class Unit:
         hb = self.engine.get_stats(self.uid, STAT.HITBOX)
         return np.array([hb, hb])*2
 
+    @property
+    def passive_aids(self):
+        # Abilities and items only change with loading and unloading abilities
+        if self.__passive_aids is None:
+            self.__passive_aids = set(self.abilities) | set(ITEMS[iid].aid for iid in self.items) - {None}
+        return self.__passive_aids
+
     @property
     def is_alive(self):
         return self.engine.get_stats(self.uid, STAT.HP) > 0
@@ -413,6 +438,7 @@ class Unit:
         self.engine.set_stats(self.uid, STAT.HP, max_hp)
         max_mana = self.engine.get_stats(self.uid, STAT.MANA, VALUE.MAX)
         self.engine.set_stats(self.uid, STAT.MANA, max_mana)
+        self.engine.set_participating(self.uid)
         self.move_to_spawn()
         self.engine.kill_dmods(self.uid)
         self.engine.kill_statuses(self.uid)
@@ -427,6 +453,24 @@ class Unit:
     def move_to_graveyard(self):
         self.engine.set_position(self.uid, self.grave_pos)
         self.engine.set_position(self.uid, self.grave_pos, value_name=VALUE.TARGET)
+        self.engine.set_participating(self.uid, False)
+
+    def get_state(self):
+        state = {}
+        for k, v in self.__dict__.items():
+            if k in _NON_STATE_ATTRIBUTES:
+                continue
+            state[k] = dict(v) if isinstance(v, defaultdict) else v
+        return state
+
+    def set_state(self, state):
+        for k, v in state.items():
+            current = self.__dict__.get(k)
+            if isinstance(current, defaultdict):
+                current.clear()
+                current.update(v)
+            else:
+                self.__dict__[k] = v
 
     @property
     def networth_str(self):
@@ -444,7 +488,7 @@ class Unit:
         s = [
             f'Draft cost: {self.draft_cost}',
             f'Current velocity: {s2ticks(velocity):.2f}/s ({velocity:.2f}/t)',
-            f'Action phase: {self.uid % self.api.engine.AGENCY_PHASE_COUNT}',
+            self.api.engine.agency.unit_str(self.uid),
             f'Spawn location: {self.spawn_pos}',
             f'Grave offset: {self.grave_offset}',
             f'Agency: {self.api.engine.agency_timers[self.uid].mean_elapsed_ms:.3f} ms',
@@ -457,13 +501,13 @@ class Unit:
                 for i in np.flatnonzero(dmods)])
             s.extend([
                 f'Delta mods: {dmod_str}',
-                make_title('Unit Cache:', length=30),
+                make_title('Passive Bonuses:', length=30),
+                self.api.passives.debug_str(self.uid),
+                make_title('Ability State:', length=30),
+                self.ability_state.debug_str(ABILITIES),
+                make_title('Item State:', length=30),
+                self.item_state.debug_str(ITEMS),
             ])
-            for k, v in self.cache.items():
-                if is_iterable(v):
-                    if len(v) > 20:
-                        v = np.flatnonzero(v)
-                s.append(f'{k}: {str(v)}')
         return '\n'.join(s)
 
     def __repr__(self):
@@ -510,7 +554,7 @@ class Creep(Unit):
         self.wave_offset = int(float(self.p['wave_offset']) * 100)
         self.scaling = float(self.p['scaling']) if 'scaling' in self.p else 1
         # Space out the wave, as collision is finnicky at the time of writing
-        self.spawn_pos += RNG.random(2) * self.engine.get_stats(self.uid, STAT.HITBOX) * 0.5
+        self.spawn_pos += self.rng.random(2) * self.engine.get_stats(self.uid, STAT.HITBOX) * 0.5
         # Prepare the first wave
         self.first_wave = True
         self.move_to_graveyard()
@@ -549,73 +593,239 @@ class Creep(Unit):
                 continue
             self.use_ability(aid, None)
 
+    batch_agency = 'creep'
+    @classmethod
+    def batch_action_phase(cls, engine, uids):
+        api = engine.logic
+        if not engine.auto_tick and not api.debug_mode:
+            super().batch_action_phase(engine, uids)
+            return
+        units = [engine.units[uid] for uid in uids]
+        # Walk all at once, as the builtin walk ability (no cost, blocked by bounded)
+        can_walk = Mechanics.get_stats(engine, uids, STAT.BOUNDED) <= 0
+        walk_mask = Mechanics.mask(engine, uids[can_walk]) & Mechanics.moveable(engine)
+        if walk_mask.any():
+            targets = np.stack([engine.units[uid].target for uid in np.flatnonzero(walk_mask)])
+            targets = Mechanics.bound_to_map_batch(api, targets)
+            Mechanics.apply_walk(engine, walk_mask, targets)
+        # Find the nearest target of every ability for all units at once. This
+        # is valid as long as no unit is moved and the target is still alive.
+        nearest = {}
+        if not any(ABILITIES[aid].moves_units for unit in units for aid in unit.passive_aids):
+            for aid in set(aid for unit in units for aid in unit.ability_slots) - {None}:
+                aid_uids = np.array([unit.uid for unit in units if aid in unit.ability_slots])
+                found = api.abilities[aid].find_nearest(engine, aid_uids)
+                if found is not None:
+                    nearest.update(((uid, aid), n) for uid, n in zip(aid_uids, found))
+        for unit in units:
+            unit.passive_phase()
+            for aid in unit.ability_slots:
+                if aid is None:
+                    continue
+                n = nearest.get((unit.uid, aid))
+                if n is not None and n[0] is not None and engine.get_stats(n[0], STAT.HP) <= 0:
+                    n = None
+                unit.use_ability(aid, None, nearest=n)
+
     def debug_str(self, *a, **k):
         return f'{super().debug_str(*a, **k)}\nSpawned at: {self.spawn_pos}\nNext wave: {self._respawn_timer}'
 
 
+class StateTable:
+    """
+    Per unit state of abilities or items, as declared by the STATE schema
+    of their classes. Every field is a preallocated list indexed by aid (or
+    iid), such that state is accessed without building keys.
+    """
+    def __init__(self, schema, count):
+        self.schema = schema
+        for name, default in schema.items():
+            setattr(self, name, [default] * count)
+
+    def debug_str(self, objects):
+        strs = []
+        for name, default in self.schema.items():
+            for i, v in enumerate(getattr(self, name)):
+                if v is default or (not is_iterable(v) and v == default):
+                    continue
+                if is_iterable(v) and len(v) > 20:
+                    v = np.flatnonzero(v)
+                strs.append(f'{objects[i]} {name}: {str(v)}')
+        return '\n'.join(strs)
+
+
+class CamperTable:
+    """
+    Parameters and aggro state of all campers, one row per camper. Owned by
+    the encounter, such that the aggro state machine of many campers can be
+    evaluated at once.
+    """
+    PARAMS = ('keep_distance', 'aggro_flank', 'aggro_range', 'aggro_range_camp',
+              'deaggro_range', 'reaggro_range', 'camp_spread')
+    COLUMNS = ('uids', 'camp', 'walk_target', 'next_walk', 'deaggro', 'aggro', *PARAMS)
+    CAPACITY_MIN = 16
+
+    def __init__(self):
+        # Columns are allocated with spare capacity, only the first count rows are in use
+        self.count = 0
+        self.capacity = 0
+        self.uids = np.zeros(0, dtype=np.int64)
+        self.camp = np.zeros((0, 2))
+        self.walk_target = np.zeros((0, 2))
+        self.next_walk = np.zeros(0)
+        self.deaggro = np.zeros(0, dtype=bool)
+        self.aggro = np.zeros(0, dtype=bool)
+        for param in self.PARAMS:
+            setattr(self, param, np.zeros(0))
+
+    def __len__(self):
+        return self.count
+
+    def _ensure_capacity(self, count):
+        if count <= self.capacity:
+            return
+        capacity = max(self.capacity, self.CAPACITY_MIN)
+        while capacity < count:
+            capacity *= 2
+        for column in self.COLUMNS:
+            array = getattr(self, column)
+            new_array = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+            new_array[:self.count] = array[:self.count]
+            setattr(self, column, new_array)
+        self.capacity = capacity
+
+    def add(self, uid, camp, next_walk, **params):
+        row = self.count
+        self._ensure_capacity(row + 1)
+        self.uids[row] = uid
+        self.camp[row] = camp
+        self.walk_target[row] = camp
+        self.next_walk[row] = next_walk
+        self.deaggro[row] = False
+        self.aggro[row] = False
+        for param in self.PARAMS:
+            getattr(self, param)[row] = params[param]
+        self.count += 1
+        return row
+
+    def evaluate(self, engine, rows):
+        """
+        Evaluate the aggro/deaggro/reaggro state machine for the campers at
+        rows against the player. Updates the aggro and deaggro state, and
+        returns a mask of the rows that should attack the player.
+        """
+        uids = self.uids[rows]
+        positions = engine.get_positions(uids)
+        hitboxes = engine.get_stats(uids, STAT.HITBOX)
+        player_pos = engine.get_position(0)
+        player_hitbox = engine.get_stats(0, STAT.HITBOX)
+        player_dist = engine.get_distances(player_pos, uids, include_hitbox=False) - hitboxes - player_hitbox
+        player_dist[player_dist < 0] = 0
+        camp = self.camp[rows]
+        my_camp_dist = np.linalg.norm(positions - camp, axis=-1) - hitboxes
+        my_camp_dist[my_camp_dist < 0] = 0
+        player_camp_dist = np.linalg.norm(player_pos - camp, axis=-1) - player_hitbox
+        player_camp_dist[player_camp_dist < 0] = 0
+        los = Mechanics.get_status(engine, uids, STAT.LOS)
+        darkness = Mechanics.scaling(Mechanics.get_status(engine, uids, STAT.DARKNESS))
+        visible = player_dist <= np.round(los * darkness)
+
+        in_aggro_range = (player_dist < self.aggro_range[rows]) | (player_camp_dist < self.aggro_range_camp[rows])
+        deaggro = self.deaggro[rows]
+        aggro = visible & in_aggro_range & ~deaggro & (engine.get_stats(0, STAT.HP) > 0)
+        deaggro[aggro] = my_camp_dist[aggro] > self.deaggro_range[rows][aggro]
+        reaggro = visible & ~aggro & deaggro & (my_camp_dist < self.reaggro_range[rows])
+        deaggro[reaggro] = False
+        deaggro[~visible] = False
+        self.deaggro[rows] = deaggro
+        self.aggro[rows] = aggro
+        return aggro
+
+    def engaged_mask(self, unit_count):
+        """Mask of units that are campers in aggro."""
+        mask = np.zeros(unit_count, dtype=bool)
+        mask[self.uids[:self.count][self.aggro[:self.count]]] = True
+        return mask
+
+
 class Camper(Unit):
     say = '"Personal space... I need my personal space..."'
+    batch_agency = 'camper'
     def _setup(self):
         self.color = (1, 0, 0)
         if len(self.default_abilities) == 0:
             self.set_abilities([ABILITY.ATTACK])
-        self.camp = self.engine.get_position(self.uid)
-        self.__keep_distance = float(self.p['keep_distance']) if 'keep_distance' in self.p else 0
-        self.__aggro_flank = float(self.p['aggro_flank']) * nsign(RNG.random()-0.5) if 'aggro_flank' in self.p else 0
-        self.__aggro_range = float(self.p['aggro_range'])
-        self.__aggro_range_camp = float(self.p['aggro_range_camp']) if 'aggro_range_camp' in self.p else self.__aggro_range
-        self.__deaggro_range = float(self.p['deaggro_range'])
-        self.__reaggro_range = float(self.p['reaggro_range'])
-        self.__camp_spread = float(self.p['camp_spread'])
-        self.__deaggro = False
-        self.__walk_target = self.camp
-        self.__next_walk = self.engine.tick
+        aggro_range = float(self.p['aggro_range'])
+        self.camper_row = self.api.campers.add(
+            self.uid, self.engine.get_position(self.uid), self.engine.tick,
+            keep_distance=float(self.p['keep_distance']) if 'keep_distance' in self.p else 0,
+            aggro_flank=float(self.p['aggro_flank']) * nsign(self.rng.random()-0.5) if 'aggro_flank' in self.p else 0,
+            aggro_range=aggro_range,
+            aggro_range_camp=float(self.p['aggro_range_camp']) if 'aggro_range_camp' in self.p else aggro_range,
+            deaggro_range=float(self.p['deaggro_range']),
+            reaggro_range=float(self.p['reaggro_range']),
+            camp_spread=float(self.p['camp_spread']),
+        )
+
+    @classmethod
+    def batch_action_phase(cls, engine, uids):
+        units = [engine.units[uid] for uid in uids]
+        rows = np.array([unit.camper_row for unit in units])
+        aggro = engine.logic.campers.evaluate(engine, rows)
+        for unit, unit_aggro in zip(units, aggro):
+            unit.passive_phase()
+            unit._do_action(unit_aggro)
 
     def action_phase(self):
-        distance_from_me = self.engine.unit_distance(self.uid, 0)
-        visible_to_me = distance_from_me <= self.view_distance
-        if visible_to_me:
-            my_camp_dist = self.engine.get_distances(self.camp, self.uid)
-            in_aggro_range_self = distance_from_me < self.__aggro_range
-            in_aggro_range_camp = self.engine.get_distances(self.camp, 0)[0] < self.__aggro_range_camp
-            in_aggro_range = in_aggro_range_self or in_aggro_range_camp
-            if in_aggro_range and not self.__deaggro and self.engine.units[0].is_alive:
-                player_pos = self.engine.get_position(0)
-                if self.__aggro_flank != 0:
-                    self.use_walk(self.flank_pos(0))
-                elif self.__keep_distance > 0:
-                    self.use_walk(self.straight_distance(0))
-                else:
-                    self.use_walk(player_pos)
-                for aid in self.ability_slots:
-                    if aid is None:
-                        continue
-                    self.use_ability(aid, player_pos)
-                if my_camp_dist > self.__deaggro_range:
-                    self.__deaggro = True
+        aggro = self.api.campers.evaluate(self.engine, np.array([self.camper_row]))
+        self._do_action(aggro[0])
+
+    def _do_action(self, aggro):
+        if aggro and self.engine.units[0].is_alive:
+            player_pos = self.engine.get_position(0)
+            if self.aggro_flank != 0:
+                self.use_walk(self.flank_pos(0))
+            elif self.keep_distance > 0:
+                self.use_walk(self.straight_distance(0))
             else:
-                if self.__deaggro is True and my_camp_dist < self.__reaggro_range:
-                    self.__deaggro = False
-                self.use_walk(self.walk_target)
+                self.use_walk(player_pos)
+            for aid in self.ability_slots:
+                if aid is None:
+                    continue
+                self.use_ability(aid, player_pos)
         else:
-            self.__deaggro = False
+            if aggro:
+                # The player died since the state was evaluated
+                self.api.campers.deaggro[self.camper_row] = False
             self.use_walk(self.walk_target)
 
+    @property
+    def camp(self):
+        return self.api.campers.camp[self.camper_row]
+
+    @property
+    def keep_distance(self):
+        return self.api.campers.keep_distance[self.camper_row]
+
+    @property
+    def aggro_flank(self):
+        return self.api.campers.aggro_flank[self.camper_row]
+
     def straight_distance(self, uid):
         my_pos = self.engine.get_position(self.uid)
         target_pos = self.engine.get_position(0)
         vector_from_target = my_pos - target_pos
         hb = Mechanics.get_stats(self.engine, uid, STAT.HITBOX) + Mechanics.get_stats(self.engine, self.uid, STAT.HITBOX)
-        final_pos = target_pos + normalize(vector_from_target, hb+self.__keep_distance)
+        final_pos = target_pos + normalize(vector_from_target, hb+self.keep_distance)
         return final_pos
 
     def flank_pos(self, uid):
         my_pos = self.engine.get_position(self.uid)
         target_pos = self.engine.get_position(0)
         target_vector = target_pos - my_pos
-        flank_vector = self.rotate_vector(target_vector, self.__aggro_flank)
+        flank_vector = self.rotate_vector(target_vector, self.aggro_flank)
         hb = Mechanics.get_stats(self.engine, uid, STAT.HITBOX) + Mechanics.get_stats(self.engine, self.uid, STAT.HITBOX)
-        flank_pos = target_pos + normalize(flank_vector, hb+self.__keep_distance)
+        flank_pos = target_pos + normalize(flank_vector, hb+self.keep_distance)
         return flank_pos
 
     @staticmethod
@@ -627,24 +837,27 @@ class Camper(Unit):
 
     @property
     def walk_target(self):
-        if self.__next_walk <= self.engine.tick:
-            self.__walk_target = self.camp+(RNG.random(2) * self.__camp_spread*2 - self.__camp_spread)
-            self.__next_walk = self.engine.tick + SEED.r * 500
-        return self.__walk_target
+        campers, row = self.api.campers, self.camper_row
+        if campers.next_walk[row] <= self.engine.tick:
+            spread = campers.camp_spread[row]
+            campers.walk_target[row] = campers.camp[row]+(self.rng.random(2) * spread*2 - spread)
+            campers.next_walk[row] = self.engine.tick + self.rng.random() * 500
+        return campers.walk_target[row]
 
     def debug_str(self, *a, **k):
+        campers, row = self.api.campers, self.camper_row
         return '\n'.join([
             f'{super().debug_str(*a, **k)}',
-            f'Camping at: {pos2str(self.camp)}',
-            f'Camp spread: {self.__camp_spread}',
-            f'Next walk: {self.__next_walk}',
-            f'Walk target: {pos2str(self.__walk_target)}',
-            f'Keep distance: {self.__keep_distance}',
-            f'Aggro flank: {self.__aggro_flank}',
-            f'Aggro range: {self.__aggro_range}',
-            f'Deaggro range: {self.__deaggro_range}',
-            f'Reaggro range: {self.__reaggro_range}',
-            f'Deaggro\'d: {self.__deaggro}',
+            f'Camping at: {pos2str(campers.camp[row])}',
+            f'Camp spread: {campers.camp_spread[row]}',
+            f'Next walk: {campers.next_walk[row]}',
+            f'Walk target: {pos2str(campers.walk_target[row])}',
+            f'Keep distance: {campers.keep_distance[row]}',
+            f'Aggro flank: {campers.aggro_flank[row]}',
+            f'Aggro range: {campers.aggro_range[row]}',
+            f'Deaggro range: {campers.deaggro_range[row]}',
+            f'Reaggro range: {campers.reaggro_range[row]}',
+            f'Deaggro\'d: {campers.deaggro[row]}',
         ])
 
 
@@ -138,3 +138,114 @@ class RateCounter:
     @property
     def time_block(self):
         return ratecounter(self)
+
+
+class Timer:
+    """
+    Aggregate the elapsed time of timed blocks (count, total, min and max)
+    in ns, using perf_counter_ns and plain ints. Use as a context manager.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', '_start')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = self.total = self.max = 0
+        self.min = None
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *a):
+        elapsed = time.perf_counter_ns() - self._start
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        if self.min is None or elapsed < self.min:
+            self.min = elapsed
+
+    @property
+    def time_block(self):
+        return self
+
+    @property
+    def mean_elapsed_ms(self):
+        return self.total / self.count / 1_000_000 if self.count else 0
+
+    @property
+    def total_ms(self):
+        return self.total / 1_000_000
+
+    @property
+    def min_ms(self):
+        return self.min / 1_000_000 if self.min is not None else 0
+
+    @property
+    def max_ms(self):
+        return self.max / 1_000_000
+
+
+class NullTimer:
+    """A Timer that records nothing."""
+    __slots__ = ()
+    count = total = max = 0
+    min = None
+    mean_elapsed_ms = total_ms = min_ms = max_ms = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        pass
+
+    def reset(self):
+        pass
+
+    @property
+    def time_block(self):
+        return self
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timers(dict):
+    """A collection of Timers by name, creating them on first use."""
+    def __missing__(self, key):
+        timer = self[key] = Timer()
+        return timer
+
+    def reset(self):
+        for timer in self.values():
+            timer.reset()
+
+
+class NullTimers:
+    """A collection of Timers that gives NULL_TIMER for every name and is always empty."""
+    def __getitem__(self, key):
+        return NULL_TIMER
+
+    def __contains__(self, key):
+        return False
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+    def items(self):
+        return ()
+
+    def values(self):
+        return ()
+
+    def reset(self):
+        pass
+
+
+NULL_TIMERS = NullTimers()